@@ -0,0 +1,183 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""HTTP caching for static assets and rendered pages.
+
+Static files are fingerprinted with a hash of their contents and served from
+`/assets/<hash>/<path>` with a year-long `immutable` cache lifetime, so browsers
+never revalidate them. Text assets are compressed once at startup. Rendered
+pages are kept in memory and served with an ETag derived from the template,
+the asset fingerprints and the context, so a repeat visit costs a 304 with no
+body and the ETag only changes when one of those does.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+from typing import Any, NamedTuple
+from urllib.parse import quote
+
+from flask import Flask, Response, abort, current_app, render_template, request
+
+from middleware import logger
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Pages may change (new deploy, new votes) so make browsers revalidate each time
+PAGE_CACHE_CONTROL = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Below this size the compression framing isn't worth it
+MIN_COMPRESS_SIZE = 512
+
+# Bounds the number of distinct rendered pages held in memory
+MAX_CACHED_PAGES = 256
+
+
+class Asset(NamedTuple):
+    digest: str
+    mimetype: str
+    # Maps content-encoding ("identity", "gzip", "br") to the encoded body
+    bodies: dict[str, bytes]
+
+
+_assets: dict[str, Asset] = {}
+_pages: dict[tuple, tuple[bytes, str]] = {}
+_pages_lock = threading.Lock()
+
+
+def _is_compressible(mimetype: str) -> bool:
+    return mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def load_assets(static_folder: str) -> None:
+    """Fingerprints and pre-compresses every file under `static_folder`."""
+    _assets.clear()
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            logical_path = os.path.relpath(path, static_folder).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                body = f.read()
+
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            bodies = {"identity": body}
+            if _is_compressible(mimetype) and len(body) >= MIN_COMPRESS_SIZE:
+                bodies["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+                if brotli is not None:
+                    bodies["br"] = brotli.compress(body, quality=11)
+
+            digest = hashlib.sha256(body).hexdigest()[:12]
+            _assets[logical_path] = Asset(digest, mimetype, bodies)
+
+    logger.info(f"Fingerprinted {len(_assets)} static assets")
+
+
+def asset_url(path: str) -> str:
+    """Returns the fingerprinted URL for a file in the static folder."""
+    asset = _assets.get(path)
+    if asset is None:
+        # Unknown files fall back to the plain static route
+        return "/" + quote(path)
+    return f"/assets/{asset.digest}/{quote(path)}"
+
+
+def _preferred_encoding(available: dict[str, bytes]) -> str:
+    accepted = request.accept_encodings
+    for encoding in ("br", "gzip"):
+        if encoding in available and accepted[encoding]:
+            return encoding
+    return "identity"
+
+
+def serve_asset(digest: str, path: str) -> Response:
+    asset = _assets.get(path)
+    if asset is None:
+        abort(404)
+
+    encoding = _preferred_encoding(asset.bodies)
+    response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    if len(asset.bodies) > 1:
+        response.vary.add("Accept-Encoding")
+
+    if digest == asset.digest:
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    else:
+        # A page from before a deploy asked for an old version, don't pin this one to it
+        response.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    response.set_etag(f"{asset.digest}-{encoding}")
+    if encoding != "identity":
+        return response.make_conditional(request)
+    # Safari fetches audio with Range requests and won't play it without a 206
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=len(asset.bodies[encoding])
+    )
+
+
+def _freeze(value: Any) -> Any:
+    """Turns a template context into something hashable for use as a cache key."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _page_etag(template_name: str, frozen_context: Any) -> str:
+    source, _, _ = current_app.jinja_env.loader.get_source(current_app.jinja_env, template_name)
+    digest = hashlib.sha256(source.encode("utf-8"))
+    for path, asset in sorted(_assets.items()):
+        digest.update(f"{path}:{asset.digest}".encode("utf-8"))
+    digest.update(repr(frozen_context).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def render_cached(template_name: str, **context: Any) -> Response:
+    """Renders a template once per distinct context and serves it with an ETag.
+
+    Requests carrying a matching `If-None-Match` get an empty 304.
+    """
+    key = (template_name, _freeze(context))
+    with _pages_lock:
+        cached = _pages.get(key)
+    if cached is None:
+        body = render_template(template_name, **context).encode("utf-8")
+        cached = (body, _page_etag(template_name, key[1]))
+        with _pages_lock:
+            if len(_pages) >= MAX_CACHED_PAGES:
+                _pages.pop(next(iter(_pages)))
+            _pages[key] = cached
+
+    body, etag = cached
+    response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    return response.make_conditional(request)
+
+
+def init_app(app: Flask) -> None:
+    """Registers the fingerprinted asset route and the `asset_url` template helper."""
+    load_assets(app.static_folder)
+    app.add_url_rule("/assets/<digest>/<path:path>", "asset", serve_asset)
+    app.jinja_env.globals["asset_url"] = asset_url
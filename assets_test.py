@@ -0,0 +1,77 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pathlib
+
+from flask import Flask
+from flask.testing import FlaskClient
+import pytest
+
+import assets
+
+AUDIO = bytes(range(256)) * 8
+SCRIPT = b"console.log('hello');\n" * 100
+
+
+@pytest.fixture
+def client(tmp_path: pathlib.Path) -> FlaskClient:
+    (tmp_path / "chime.mp3").write_bytes(AUDIO)
+    (tmp_path / "app.js").write_bytes(SCRIPT)
+    (tmp_path / "page.html").write_text("<script src=\"{{ asset_url('app.js') }}\"></script>")
+    app = Flask(__name__, static_folder=str(tmp_path), template_folder=str(tmp_path))
+    app.add_url_rule("/", "page", lambda: assets.render_cached("page.html"))
+    assets.init_app(app)
+    return app.test_client()
+
+
+def test_range_request_gets_partial_content(client: FlaskClient) -> None:
+    response = client.get(assets.asset_url("chime.mp3"), headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 100-199/{len(AUDIO)}"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.data == AUDIO[100:200]
+
+
+def test_unsatisfiable_range(client: FlaskClient) -> None:
+    response = client.get(
+        assets.asset_url("chime.mp3"), headers={"Range": f"bytes={len(AUDIO)}-"}
+    )
+    assert response.status_code == 416
+
+
+def test_compressed_body_ignores_range(client: FlaskClient) -> None:
+    response = client.get(
+        assets.asset_url("app.js"),
+        headers={"Range": "bytes=0-9", "Accept-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+
+
+def test_page_revalidates_with_304(client: FlaskClient) -> None:
+    page = client.get("/")
+    assert page.status_code == 200
+    assert page.headers["Cache-Control"] == "no-cache"
+
+    revisit = client.get("/", headers={"If-None-Match": page.headers["ETag"]})
+    assert revisit.status_code == 304
+    assert revisit.data == b""
+
+
+def test_page_etag_changes_with_assets(client: FlaskClient, tmp_path: pathlib.Path) -> None:
+    etag = client.get("/").headers["ETag"]
+    (tmp_path / "app.js").write_bytes(SCRIPT + b"// changed\n")
+    assets.load_assets(str(tmp_path))
+    assets._pages.clear()
+    assert client.get("/").headers["ETag"] != etag
@@ -0,0 +1,75 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares TTS latency against answer length, single call versus sentence fan-out.
+
+Uses the local TTS stand-in by default; its simulated latency can be tuned with
+LOCAL_TTS_LATENCY_BASE_MS and LOCAL_TTS_LATENCY_PER_CHAR_MS. Set TTS_BACKEND to
+anything else (with ELEVEN_API_KEY) to measure the real provider.
+
+Usage:
+    python benchmarks/bench_tts_fanout.py --words 5 20 50 100 200
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TTS_BACKEND", "local")
+
+import mp3  # noqa: E402
+import parsing  # noqa: E402
+
+SENTENCE = "The quick brown fox jumps over the lazy dog near the river bank."
+
+
+def make_answer(words: int) -> str:
+    sentence_words = SENTENCE.split()
+    text = []
+    while len(text) < words:
+        text.extend(sentence_words)
+    return " ".join(text[:words]).rstrip(".") + "."
+
+
+def timed(func, *args) -> tuple[float, bytes]:
+    start = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--words", type=int, nargs="+", default=[5, 20, 50, 100, 200])
+    args = parser.parse_args()
+
+    if os.environ["TTS_BACKEND"] != "local":
+        parsing.check_auth_keys()
+
+    print(f"{'words':>6} {'chars':>6} {'chunks':>6} {'single ms':>10} {'fan-out ms':>11} {'frames':>7}")
+    for words in args.words:
+        answer = make_answer(words)
+        chunks = parsing.split_into_chunks(answer)
+        single_ms, _ = timed(parsing.synthesize_chunk, answer)
+        # Call the undecorated function so the speech cache doesn't hide the work
+        fanout_ms, audio = timed(parsing.text_to_speech.__wrapped__, answer)
+        frames = len(list(mp3.iter_frames(audio)))
+        print(f"{words:>6} {len(answer):>6} {len(chunks):>6} {single_ms:>10.0f} {fanout_ms:>11.0f} {frames:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replays recorded request traces against the app and reports latencies.
+
+Requests are re-issued in process against `main.app` at their recorded
+offsets, divided by `--speed`. Firebase auth, Whisper, ChatCompletion and
+ElevenLabs are replaced by local stand-ins with fixed simulated latencies, and
+the database is a scratch SQLite file unless DATABASE_URL is set, so a replay
+of the same trace file always sends the same requests at the same times.
+
+Usage:
+    python benchmarks/replay_traces.py traces.jsonl --speed 2
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_scratch_db = os.path.join(tempfile.mkdtemp(), "replay.db")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_scratch_db}")
+os.environ.setdefault("TTS_BACKEND", "local")
+for name in ("DB_USER", "DB_PASSWORD", "DB_NAME", "CLOUD_SQL_CONNECTION_NAME",
+             "ELEVEN_API_KEY", "OPENAI_API_KEY"):
+    os.environ.setdefault(name, "replay")
+os.environ.pop("TRACE_FILE", None)
+
+import firebase_admin  # noqa: E402
+import openai  # noqa: E402
+
+import database  # noqa: E402
+import local_tts  # noqa: E402
+import main  # noqa: E402
+import migrations  # noqa: E402
+import mp3  # noqa: E402
+import tracing  # noqa: E402
+
+# Simulated upstream latencies
+WHISPER_BASE_MS = 300
+WHISPER_PER_AUDIO_SECOND_MS = 50
+CHAT_BASE_MS = 500
+CHAT_PER_WORD_MS = 20
+
+DEFAULT_AUDIO_MS = 3000
+# static/recording.js asks the browser to record at this bitrate
+RECORDING_BITS_PER_SECOND = 24000
+
+
+def _sleep_ms(ms: float) -> None:
+    time.sleep(ms / 1000)
+
+
+def fake_verify_id_token(token: str) -> dict:
+    return {"uid": token, "exp": time.time() + 3600}
+
+
+def fake_transcribe_raw(model: str, contents: bytes, filename: str) -> dict:
+    try:
+        seconds = mp3.duration(contents)
+    except mp3.Mp3Error:
+        seconds = DEFAULT_AUDIO_MS / 1000
+    _sleep_ms(WHISPER_BASE_MS + WHISPER_PER_AUDIO_SECOND_MS * seconds)
+    # Distinct uploads get distinct questions, so they miss the answer and speech
+    # caches and aren't coalesced, just like real questions
+    recording = hashlib.sha1(contents).hexdigest()[:12]
+    return {"text": f"Why is the sky blue? (recording {recording})"}
+
+
+def fake_chat_completion(model: str, messages: list) -> dict:
+    match = re.search(r"(\d+) words maximum", messages[1]["content"])
+    words = int(match.group(1)) if match else 20
+    _sleep_ms(CHAT_BASE_MS + CHAT_PER_WORD_MS * words)
+    # Answers to different questions are synthesized separately
+    question = hashlib.sha1(messages[-1]["content"].encode("utf-8")).hexdigest()[:12]
+    answer = " ".join(["word"] * max(words - 2, 0) + [question, "end."])
+    return {"choices": [{"message": {"content": answer}}]}
+
+
+def install_stand_ins() -> None:
+    firebase_admin.auth.verify_id_token = fake_verify_id_token
+    openai.Audio.transcribe_raw = fake_transcribe_raw
+    openai.ChatCompletion.create = fake_chat_completion
+
+
+def synthetic_audio(trace: dict, index: int) -> bytes:
+    """Silent mp3 matching the recorded duration (or size), unique per request."""
+    frame_ms = 1152 / 44100 * 1000
+    if trace.get("ad"):
+        frames = round(trace["ad"] / frame_ms)
+    elif trace.get("ab"):
+        # Traces from before clients reported durations: assume the browser's bitrate
+        frames = round(trace["ab"] * 8 / RECORDING_BITS_PER_SECOND * 1000 / frame_ms)
+    else:
+        frames = round(DEFAULT_AUDIO_MS / frame_ms)
+    # A distinct ID3v1 trailer keeps identical recordings apart in the transcript
+    # cache, and so the transcripts, answers and audio of every replay differ
+    trailer = b"TAG" + f"replay-{index}".encode().ljust(125, b"\0")
+    return local_tts.SILENT_FRAME * max(frames, 1) + trailer
+
+
+def build_request(trace: dict, index: int) -> dict | None:
+    route = trace.get("r")
+    if not route or "<" in route:
+        # Routes with path parameters can't be rebuilt from an anonymized trace
+        return None
+    kwargs = {
+        "method": trace["m"],
+        "path": route,
+        "headers": {"Authorization": f"Bearer {trace.get('u', 'replay-user')}"},
+    }
+    if route == "/ask/":
+        kwargs["content_type"] = "multipart/form-data"
+        kwargs["data"] = {
+            "audio_file": (io.BytesIO(synthetic_audio(trace, index)), f"replay-{index}"),
+            "chat_context": json.dumps(["earlier message"] * trace.get("c", 0)),
+            "response_length": str(trace.get("rl") or 20),
+        }
+    return kwargs
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main_replay() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace_file")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay this many times faster than recorded")
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    install_stand_ins()
+    traces = tracing.read_traces(args.trace_file)
+    if not traces:
+        sys.exit("No traces to replay")
+
+    client = main.app.test_client()
+    migrations.run_migrations(database.init_connection_engine())
+    client.get("/")  # runs the first request hooks: database engines and API keys
+    for uid in {trace.get("u", "replay-user") for trace in traces}:
+        database.initialise_user_if_required(uid)
+        database.set_user_tokens(uid, 10**9)
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    statuses: dict[str, dict[int, int]] = defaultdict(lambda: defaultdict(int))
+    lock = threading.Lock()
+    skipped = 0
+
+    def issue(kwargs: dict) -> None:
+        start = time.perf_counter()
+        response = main.app.test_client().open(**kwargs)
+        elapsed = (time.perf_counter() - start) * 1000
+        key = f"{kwargs['method']} {kwargs['path']}"
+        with lock:
+            latencies[key].append(elapsed)
+            statuses[key][response.status_code] += 1
+
+    origin = traces[0]["t"]
+    replay_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for index, trace in enumerate(traces):
+            kwargs = build_request(trace, index)
+            if kwargs is None:
+                skipped += 1
+                continue
+            delay = (trace["t"] - origin) / args.speed - (time.perf_counter() - replay_start)
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(issue, kwargs)
+    wall = time.perf_counter() - replay_start
+
+    print(f"Replayed {len(traces) - skipped} requests in {wall:.1f}s "
+          f"at {args.speed}x ({skipped} skipped)")
+    print(f"{'route':<20} {'count':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  statuses")
+    for key, values in sorted(latencies.items()):
+        print(f"{key:<20} {len(values):>6} {statistics.median(values):>8.0f} "
+              f"{percentile(values, 0.9):>8.0f} {percentile(values, 0.99):>8.0f} "
+              f"{max(values):>8.0f}  {dict(statuses[key])}")
+
+
+if __name__ == "__main__":
+    main_replay()
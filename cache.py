@@ -0,0 +1,393 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pluggable caches for auth results, token balances and upstream answers.
+
+Every cache belongs to a namespace with its own TTL, size limits and hit/miss
+counters. The backend is chosen with the `CACHE_BACKEND` environment variable:
+
+* `memory` (default): an LRU dictionary private to each worker process.
+* `shared`: fixed-size mmap files in `CACHE_SHM_DIR`, shared by every worker on
+  the host.
+* `redis`: an external Redis at `CACHE_REDIS_URL`, shared by every host.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from functools import wraps
+from typing import Any, NamedTuple, TypeVar
+
+a = TypeVar("a")
+
+
+class NamespaceConfig(NamedTuple):
+    # Seconds an entry stays valid
+    ttl: float
+    # Maximum number of entries kept for the namespace
+    max_entries: int
+    # Values that serialise to more than this are not cached
+    max_value_bytes: int
+
+
+NAMESPACES: dict[str, NamespaceConfig] = {
+    "auth": NamespaceConfig(ttl=300, max_entries=4096, max_value_bytes=512),
+    "tokens": NamespaceConfig(ttl=10, max_entries=4096, max_value_bytes=64),
+    "transcripts": NamespaceConfig(ttl=3600, max_entries=1024, max_value_bytes=4096),
+    "answers": NamespaceConfig(ttl=3600, max_entries=1024, max_value_bytes=8192),
+    "speech": NamespaceConfig(ttl=3600, max_entries=32, max_value_bytes=512 * 1024),
+    # Audio of individual answers, for idempotent retries and deferred audio
+    # fetches. A 200 word answer is about 80s, 1.3MB at 128kbps, so this holds up
+    # to 128MB per worker (or in CACHE_SHM_DIR with the shared backend).
+    "answer_audio": NamespaceConfig(ttl=3600, max_entries=64, max_value_bytes=2 * 1024 * 1024),
+    "deferred_speech": NamespaceConfig(ttl=3600, max_entries=4096, max_value_bytes=8192),
+    "idempotency": NamespaceConfig(ttl=24 * 3600, max_entries=8192, max_value_bytes=16384),
+}
+
+
+def make_key(*parts: Any) -> str:
+    """Builds a fixed-length cache key from JSON-serialisable parts."""
+    encoded = json.dumps(parts, sort_keys=True, default=repr).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class CacheBackend:
+    """A cache for a single namespace.
+
+    `None` is never cached, so `get` returning `None` always means a miss.
+    """
+
+    def __init__(self, namespace: str, config: NamespaceConfig) -> None:
+        self.namespace = namespace
+        self.config = config
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.rejected = 0
+
+    def get(self, key: str) -> Any | None:
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> bool:
+        """Stores `value` under `key`.
+
+        Returns:
+            False if the value wasn't stored: it is None, the TTL isn't
+            positive or it is larger than the namespace allows.
+        """
+        if value is None:
+            return False
+        ttl = self.config.ttl if ttl is None else min(ttl, self.config.ttl)
+        if ttl <= 0:
+            return False
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.config.max_value_bytes:
+            self.rejected += 1
+            return False
+        self.sets += 1
+        self._set(key, payload, time.time() + ttl)
+        return True
+
+    def add(self, key: str, value: Any, ttl: float | None = None) -> bool:
+        """Stores `value` only if `key` has no live entry, atomically.
+
+        Every process sharing the cache sees the same outcome, so this can be
+        used to claim a key.
+
+        Returns:
+            True if the value was stored.
+        """
+        ttl = self.config.ttl if ttl is None else min(ttl, self.config.ttl)
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if value is None or ttl <= 0 or len(payload) > self.config.max_value_bytes:
+            raise ValueError(f"Value can't be stored in the {self.namespace} cache")
+        added = self._add(key, payload, time.time() + ttl)
+        if added:
+            self.sets += 1
+        return added
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "sets": self.sets,
+            "rejected": self.rejected,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+    def _get(self, key: str) -> Any | None:
+        raise NotImplementedError
+
+    def _set(self, key: str, payload: bytes, expires_at: float) -> None:
+        raise NotImplementedError
+
+    def _add(self, key: str, payload: bytes, expires_at: float) -> bool:
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """In-process least-recently-used cache."""
+
+    def __init__(self, namespace: str, config: NamespaceConfig) -> None:
+        super().__init__(namespace, config)
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return pickle.loads(payload)
+
+    def _set(self, key: str, payload: bytes, expires_at: float) -> None:
+        with self._lock:
+            self._store(key, payload, expires_at)
+
+    def _add(self, key: str, payload: bytes, expires_at: float) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return False
+            self._store(key, payload, expires_at)
+        return True
+
+    def _store(self, key: str, payload: bytes, expires_at: float) -> None:
+        # Callers hold self._lock
+        self._entries[key] = (expires_at, payload)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.config.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict[str, Any]:
+        stats = super().stats()
+        stats["entries"] = len(self._entries)
+        stats["evictions"] = self.evictions
+        return stats
+
+
+class SharedMemoryCache(CacheBackend):
+    """Cache in a memory-mapped file shared by every process on the host.
+
+    The file is a direct-mapped table of `max_entries` fixed-size slots; a key
+    lives in the slot its hash points to and overwrites whatever was there.
+    Slots are guarded by byte-range file locks across processes and a mutex
+    within this one. Hit/miss counters are per process.
+    """
+
+    # Key digest, expiry timestamp and payload length
+    _header = struct.Struct("<16sdI")
+
+    def __init__(self, namespace: str, config: NamespaceConfig, directory: str) -> None:
+        super().__init__(namespace, config)
+        self._slot_size = self._header.size + config.max_value_bytes
+        size = self._slot_size * config.max_entries
+        path = os.path.join(directory, f"mrkia-cache-{namespace}")
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            # A resized namespace starts empty rather than misreading old slots
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    os.ftruncate(self._fd, 0)
+                    os.ftruncate(self._fd, size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    def _slot(self, key: str) -> tuple[bytes, int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        index = int.from_bytes(digest[:8], "little") % self.config.max_entries
+        return digest, index * self._slot_size
+
+    def _get(self, key: str) -> Any | None:
+        digest, offset = self._slot(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_SH, self._slot_size, offset)
+            try:
+                stored, expires_at, length = self._header.unpack_from(self._map, offset)
+                if stored != digest or expires_at <= time.time():
+                    return None
+                start = offset + self._header.size
+                payload = self._map[start:start + length]
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._slot_size, offset)
+        return pickle.loads(payload)
+
+    def _set(self, key: str, payload: bytes, expires_at: float) -> None:
+        digest, offset = self._slot(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._slot_size, offset)
+            try:
+                self._write_slot(offset, digest, payload, expires_at)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._slot_size, offset)
+
+    def _add(self, key: str, payload: bytes, expires_at: float) -> bool:
+        digest, offset = self._slot(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._slot_size, offset)
+            try:
+                stored, stored_expires_at, _ = self._header.unpack_from(self._map, offset)
+                if stored == digest and stored_expires_at > time.time():
+                    return False
+                # Like _set, this evicts another key that hashes to the same slot
+                self._write_slot(offset, digest, payload, expires_at)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._slot_size, offset)
+        return True
+
+    def _write_slot(self, offset: int, digest: bytes, payload: bytes, expires_at: float) -> None:
+        # Callers hold the slot's locks
+        self._header.pack_into(self._map, offset, digest, expires_at, len(payload))
+        start = offset + self._header.size
+        self._map[start:start + len(payload)] = payload
+
+    def delete(self, key: str) -> None:
+        digest, offset = self._slot(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._slot_size, offset)
+            try:
+                stored, _, _ = self._header.unpack_from(self._map, offset)
+                if stored == digest:
+                    self._header.pack_into(self._map, offset, b"", 0.0, 0)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._slot_size, offset)
+
+
+class RedisCache(CacheBackend):
+    """Cache in an external Redis shared by every host.
+
+    `client` can be anything with Redis' `get`, `set(..., px=..., nx=...)` and
+    `delete` methods, so tests can pass a local stand-in. Redis' own eviction policy
+    enforces the overall size; `max_entries` is not applied per namespace.
+    """
+
+    def __init__(self, namespace: str, config: NamespaceConfig, client: Any = None) -> None:
+        super().__init__(namespace, config)
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(os.environ["CACHE_REDIS_URL"])
+        self._client = client
+
+    def _redis_key(self, key: str) -> str:
+        return f"mrkia:{self.namespace}:{key}"
+
+    def _get(self, key: str) -> Any | None:
+        payload = self._client.get(self._redis_key(key))
+        return None if payload is None else pickle.loads(payload)
+
+    def _set(self, key: str, payload: bytes, expires_at: float) -> None:
+        ttl_ms = max(int((expires_at - time.time()) * 1000), 1)
+        self._client.set(self._redis_key(key), payload, px=ttl_ms)
+
+    def _add(self, key: str, payload: bytes, expires_at: float) -> bool:
+        ttl_ms = max(int((expires_at - time.time()) * 1000), 1)
+        return bool(self._client.set(self._redis_key(key), payload, px=ttl_ms, nx=True))
+
+    def delete(self, key: str) -> None:
+        self._client.delete(self._redis_key(key))
+
+
+_caches: dict[str, CacheBackend] = {}
+_caches_lock = threading.Lock()
+
+
+def create_cache(namespace: str, backend: str | None = None) -> CacheBackend:
+    """Creates a cache for `namespace` using `backend`, or `CACHE_BACKEND`."""
+    config = NAMESPACES[namespace]
+    backend = backend or os.environ.get("CACHE_BACKEND", "memory")
+    if backend == "memory":
+        return LRUCache(namespace, config)
+    if backend == "shared":
+        directory = os.environ.get("CACHE_SHM_DIR", "/dev/shm")
+        return SharedMemoryCache(namespace, config, directory)
+    if backend == "redis":
+        return RedisCache(namespace, config)
+    raise ValueError(f"Unsupported CACHE_BACKEND '{backend}'")
+
+
+def get_cache(namespace: str) -> CacheBackend:
+    """Returns this process' cache for `namespace`, creating it on first use."""
+    cache = _caches.get(namespace)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(namespace)
+            if cache is None:
+                cache = _caches[namespace] = create_cache(namespace)
+    return cache
+
+
+def all_stats() -> dict[str, dict[str, Any]]:
+    """Hit/miss statistics for every namespace used so far."""
+    return {namespace: cache.stats() for namespace, cache in _caches.items()}
+
+
+def cached(namespace: str) -> Callable[[Callable[..., a]], Callable[..., a]]:
+    """Caches a function's results in `namespace`, keyed on its arguments."""
+
+    def decorator(func: Callable[..., a]) -> Callable[..., a]:
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def decorated_function(*args: Any, **kwargs: Any) -> a:
+            cache = get_cache(namespace)
+            # Key on every argument, defaults included, so that equivalent calls
+            # share an entry however they were written
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = make_key(func.__name__, arguments.arguments)
+            value = cache.get(key)
+            if value is None:
+                value = func(*args, **kwargs)
+                cache.set(key, value)
+            return value
+
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,268 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import pathlib
+import time
+
+import pytest
+
+from cache import CacheBackend, LRUCache, NamespaceConfig, RedisCache, SharedMemoryCache
+
+CONFIG = NamespaceConfig(ttl=60, max_entries=8, max_value_bytes=64)
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+class FakeRedis:
+    """The subset of the Redis client RedisCache uses, with expiry."""
+
+    def __init__(self) -> None:
+        self.entries: dict[str, tuple[float, bytes]] = {}
+
+    def get(self, name: str) -> bytes | None:
+        entry = self.entries.get(name)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def set(self, name: str, value: bytes, px: int, nx: bool = False) -> bool | None:
+        if nx and self.get(name) is not None:
+            return None
+        self.entries[name] = (time.time() + px / 1000, value)
+        return True
+
+    def delete(self, name: str) -> None:
+        self.entries.pop(name, None)
+
+
+@pytest.fixture(params=["memory", "shared", "redis"])
+def backend(request: pytest.FixtureRequest, tmp_path: pathlib.Path) -> CacheBackend:
+    if request.param == "memory":
+        return LRUCache("test", CONFIG)
+    if request.param == "shared":
+        return shared(tmp_path)
+    return RedisCache("test", CONFIG, client=FakeRedis())
+
+
+def shared(tmp_path: pathlib.Path, config: NamespaceConfig = CONFIG) -> SharedMemoryCache:
+    return SharedMemoryCache("test", config, str(tmp_path))
+
+
+def colliding_keys(cache: SharedMemoryCache) -> tuple[str, str]:
+    """Two different keys that hash to the same slot."""
+    first = "key-0"
+    slot = cache._slot(first)[1]
+    for i in itertools.count(1):
+        if cache._slot(f"key-{i}")[1] == slot:
+            return first, f"key-{i}"
+
+
+def test_shared_between_instances(tmp_path: pathlib.Path) -> None:
+    # Each worker process opens its own mapping of the same file
+    assert shared(tmp_path).set("key", {"answer": 42})
+    assert shared(tmp_path).get("key") == {"answer": 42}
+
+
+def test_slot_collision_evicts_previous_key(tmp_path: pathlib.Path) -> None:
+    cache = shared(tmp_path)
+    first, second = colliding_keys(cache)
+    cache.set(first, "first")
+    cache.set(second, "second")
+
+    assert cache.get(first) is None
+    assert cache.get(second) == "second"
+
+
+def test_add_claims_slot_of_a_colliding_key(tmp_path: pathlib.Path) -> None:
+    cache = shared(tmp_path)
+    first, second = colliding_keys(cache)
+    assert cache.add(first, "first")
+    assert not cache.add(first, "again")
+    # A different key isn't a live entry for this one, so it's replaced
+    assert cache.add(second, "second")
+    assert cache.get(first) is None
+
+
+def test_resized_namespace_starts_empty(tmp_path: pathlib.Path) -> None:
+    shared(tmp_path).set("key", "value")
+    resized = shared(tmp_path, CONFIG._replace(max_entries=16))
+    assert resized.get("key") is None
+
+
+def test_set_then_get(backend: CacheBackend) -> None:
+    assert backend.get("key") is None
+    assert backend.set("key", {"answer": 42})
+    assert backend.get("key") == {"answer": 42}
+    assert backend.set("key", "replaced")
+    assert backend.get("key") == "replaced"
+
+
+def test_none_is_never_cached(backend: CacheBackend) -> None:
+    assert not backend.set("key", None)
+    with pytest.raises(ValueError):
+        backend.add("key", None)
+
+
+def test_delete(backend: CacheBackend) -> None:
+    backend.set("key", "value")
+    backend.delete("key")
+    backend.delete("missing")
+    assert backend.get("key") is None
+
+
+def test_add_only_stores_missing_keys(backend: CacheBackend) -> None:
+    assert backend.add("key", "first")
+    assert not backend.add("key", "second")
+    assert backend.get("key") == "first"
+
+    backend.delete("key")
+    assert backend.add("key", "third")
+    assert backend.get("key") == "third"
+
+
+def test_add_does_not_count_refused_writes(backend: CacheBackend) -> None:
+    backend.add("key", "first")
+    backend.add("key", "second")
+    assert backend.stats()["sets"] == 1
+
+
+def test_entries_expire(backend: CacheBackend, clock: Clock) -> None:
+    backend.set("short", "value", ttl=5)
+    backend.set("long", "value")
+
+    clock.now += 5
+    assert backend.get("short") is None
+    assert backend.get("long") == "value"
+    clock.now += CONFIG.ttl
+    assert backend.get("long") is None
+
+
+def test_ttl_is_capped_by_the_namespace(backend: CacheBackend, clock: Clock) -> None:
+    backend.set("key", "value", ttl=CONFIG.ttl * 10)
+    clock.now += CONFIG.ttl
+    assert backend.get("key") is None
+
+
+def test_non_positive_ttl_is_not_stored(backend: CacheBackend) -> None:
+    assert not backend.set("key", "value", ttl=0)
+    assert backend.get("key") is None
+    with pytest.raises(ValueError):
+        backend.add("key", "value", ttl=0)
+
+
+def test_add_replaces_expired_entry(backend: CacheBackend, clock: Clock) -> None:
+    assert backend.add("key", "first", ttl=5)
+    clock.now += 5
+    assert backend.add("key", "second")
+    assert backend.get("key") == "second"
+
+
+def test_oversized_value_is_rejected(backend: CacheBackend) -> None:
+    assert not backend.set("key", b"x" * CONFIG.max_value_bytes)
+    assert backend.get("key") is None
+    assert backend.stats()["rejected"] == 1
+    with pytest.raises(ValueError):
+        backend.add("key", b"x" * CONFIG.max_value_bytes)
+
+
+def test_stats_count_hits_and_misses(backend: CacheBackend) -> None:
+    backend.set("key", "value")
+    backend.get("key")
+    backend.get("key")
+    backend.get("missing")
+
+    stats = backend.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (2, 1, 0.667)
+
+
+def lru(max_entries: int = 3) -> LRUCache:
+    return LRUCache("test", CONFIG._replace(max_entries=max_entries))
+
+
+def test_lru_evicts_least_recently_set() -> None:
+    cache = lru()
+    for key in ["a", "b", "c", "d"]:
+        cache.set(key, key)
+
+    assert cache.get("a") is None
+    assert [cache.get(key) for key in ["b", "c", "d"]] == ["b", "c", "d"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_get_refreshes_recency() -> None:
+    cache = lru()
+    for key in ["a", "b", "c"]:
+        cache.set(key, key)
+    cache.get("a")
+    cache.set("d", "d")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+
+
+def test_lru_overwrite_refreshes_recency() -> None:
+    cache = lru()
+    for key in ["a", "b", "c"]:
+        cache.set(key, key)
+    cache.set("a", "again")
+    cache.set("d", "d")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "again"
+
+
+def test_lru_refused_add_keeps_recency() -> None:
+    cache = lru()
+    for key in ["a", "b", "c"]:
+        cache.set(key, key)
+    assert not cache.add("a", "again")
+    cache.set("d", "d")
+
+    # The refused add didn't touch "a", so it was still the oldest entry
+    assert cache.get("a") is None
+    assert cache.get("b") == "b"
+
+
+def test_lru_expired_entries_are_dropped_on_read(clock: Clock) -> None:
+    cache = lru()
+    cache.set("key", "value", ttl=5)
+    clock.now += 5
+
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+    assert cache.add("key", "fresh")
+    assert cache.get("key") == "fresh"
+
+
+def test_redis_keys_are_namespaced() -> None:
+    client = FakeRedis()
+    RedisCache("auth", CONFIG, client=client).set("key", "auth value")
+    RedisCache("tokens", CONFIG, client=client).set("key", "tokens value")
+
+    assert sorted(client.entries) == ["mrkia:auth:key", "mrkia:tokens:key"]
+    assert RedisCache("auth", CONFIG, client=client).get("key") == "auth value"
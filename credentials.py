@@ -57,6 +57,8 @@ def get_cred_config() -> dict[str, str]:
             "DB_PASSWORD": os.environ["DB_PASSWORD"],
             "DB_NAME": os.environ["DB_NAME"],
             "DB_HOST": os.environ.get("DB_HOST", None),
+            "DB_DRIVER": os.environ.get("DB_DRIVER", "pg8000"),
+            "DB_REPLICA_HOSTS": os.environ.get("DB_REPLICA_HOSTS", None),
             "ELEVEN_API_KEY": os.environ["ELEVEN_API_KEY"],
             "OPENAI_API_KEY": os.environ["OPENAI_API_KEY"],
             "CLOUD_SQL_CONNECTION_NAME": os.environ["CLOUD_SQL_CONNECTION_NAME"],
@@ -14,17 +14,27 @@
 
 from __future__ import annotations
 
+import contextlib
+import contextvars
 import datetime
+import itertools
 import os
-from typing import Any
+import time
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any, Literal, NamedTuple, TypeVar
 
 import sqlalchemy
+from sqlalchemy import bindparam, func
 from sqlalchemy.orm import close_all_sessions
 from sqlalchemy.pool import NullPool
 from sqlalchemy.exc import IntegrityError
 
 import credentials
+import migrations
+import pool_monitor
+from cache import get_cache
 from middleware import logger
+from single_flight import single_flight
 
 # This global variable is declared with a value of `None`, instead of calling
 # `init_connection_engine()` immediately, to simplify testing. In general, it
@@ -32,18 +42,179 @@ from middleware import logger
 # -- there is no need to wait for the first request.
 db = None
 
+# Read replicas, populated alongside `db` when any are configured. Reads that can
+# tolerate replication lag are spread across these round-robin.
+replicas: list[sqlalchemy.engine.base.Engine] = []
+
+# How long a replica that failed to connect is skipped before being retried
+REPLICA_RETRY_SECONDS = 30
+
+_replica_counter = itertools.count()
+_replica_down_until: dict[int, float] = {}
+
+metadata = sqlalchemy.MetaData()
+
+pet_votes = sqlalchemy.Table(
+    "pet_votes",
+    metadata,
+    sqlalchemy.Column("vote_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("time_cast", sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Column("candidate", sqlalchemy.String(6), nullable=False),
+    sqlalchemy.Column("uid", sqlalchemy.String(128), nullable=False),
+)
+
+active_users = sqlalchemy.Table(
+    "active_users",
+    metadata,
+    sqlalchemy.Column("user_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("username", sqlalchemy.String(128), nullable=False, unique=True),
+    sqlalchemy.Column(
+        "tokens", sqlalchemy.Integer, nullable=False, server_default=sqlalchemy.text("0")
+    ),
+)
+
+# Statements are built once at import time. SQLAlchemy keys its compiled cache
+# on the statement structure, so reusing these objects means each one is only
+# compiled once per dialect rather than on every call.
+_user_exists_stmt = sqlalchemy.select(func.count()).where(
+    active_users.c.username == bindparam("username")
+)
+_insert_user_stmt = active_users.insert()
+_recent_votes_stmt = (
+    sqlalchemy.select(pet_votes.c.candidate, pet_votes.c.time_cast)
+    .order_by(pet_votes.c.time_cast.desc())
+    .limit(5)
+)
+_candidate_count_stmt = sqlalchemy.select(func.count(pet_votes.c.vote_id)).where(
+    pet_votes.c.candidate == bindparam("candidate")
+)
+_set_tokens_stmt = (
+    active_users.update()
+    .where(active_users.c.username == bindparam("uid"))
+    .values(tokens=bindparam("amount"))
+)
+_add_tokens_stmt = (
+    active_users.update()
+    .where(active_users.c.username == bindparam("uid"))
+    .values(tokens=active_users.c.tokens + bindparam("amount"))
+    .returning(active_users.c.tokens)
+)
+_select_tokens_stmt = sqlalchemy.select(active_users.c.tokens).where(
+    active_users.c.username == bindparam("username")
+)
+_insert_vote_stmt = pet_votes.insert()
+_user_id_range_stmt = sqlalchemy.select(
+    func.min(active_users.c.user_id), func.max(active_users.c.user_id)
+)
+
+# Staging table for bulk token changes on databases other than PostgreSQL, which
+# can't name the columns of a VALUES list. Created and dropped in each chunk's
+# transaction.
+_staging_metadata = sqlalchemy.MetaData()
+_token_changes = sqlalchemy.Table(
+    "token_changes",
+    _staging_metadata,
+    sqlalchemy.Column("uid", sqlalchemy.String(128), primary_key=True),
+    sqlalchemy.Column("amount", sqlalchemy.Integer, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+# Per-driver connect arguments. psycopg (v3) switches to a server-side prepared
+# statement once a query has been seen `prepare_threshold` times on a connection.
+# pg8000 always uses the unnamed statement, so it gets no extra arguments.
+DRIVER_CONNECT_ARGS: dict[str, dict[str, Any]] = {
+    "pg8000": {},
+    "psycopg": {"prepare_threshold": 1},
+    "psycopg2": {},
+}
+
+
+class QueryStats:
+    """Number of queries and time spent in the database for one request."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_seconds = 0.0
+        self.slowest_seconds = 0.0
+
+    def record(self, elapsed: float) -> None:
+        self.count += 1
+        self.total_seconds += elapsed
+        self.slowest_seconds = max(self.slowest_seconds, elapsed)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "queries": self.count,
+            "query_ms": round(self.total_seconds * 1000, 3),
+            "slowest_query_ms": round(self.slowest_seconds * 1000, 3),
+        }
 
-def init_connection_engine() -> sqlalchemy.engine.base.Engine:
-    """Initializes a connection pool for a Cloud SQL instance of PostgreSQL.
 
-    Returns:
-        A SQLAlchemy Engine instance.
-    """
+_query_stats: contextvars.ContextVar[QueryStats | None] = contextvars.ContextVar(
+    "query_stats", default=None
+)
+
+
+def begin_query_stats() -> QueryStats:
+    """Start counting queries for the current request (or other unit of work)."""
+    stats = QueryStats()
+    _query_stats.set(stats)
+    return stats
+
+
+def end_query_stats() -> QueryStats | None:
+    """Stop counting queries and return what was recorded since `begin_query_stats`."""
+    stats = _query_stats.get()
+    _query_stats.set(None)
+    return stats
+
+
+def instrument_engine(engine: sqlalchemy.engine.base.Engine) -> None:
+    """Attach cursor events that time every statement run on `engine`."""
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(
+        conn: sqlalchemy.engine.Connection,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: sqlalchemy.engine.ExecutionContext | None,
+        executemany: bool,
+    ) -> None:
+        conn.info.setdefault("query_start_time", []).append((context, time.perf_counter()))
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(
+        conn: sqlalchemy.engine.Connection,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: sqlalchemy.engine.ExecutionContext | None,
+        executemany: bool,
+    ) -> None:
+        _, start = conn.info["query_start_time"].pop()
+        stats = _query_stats.get()
+        if stats is not None:
+            stats.record(time.perf_counter() - start)
+
+    @sqlalchemy.event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context: sqlalchemy.engine.ExceptionContext) -> None:
+        # A failed statement never reaches after_cursor_execute
+        conn = exception_context.connection
+        starts = conn.info.get("query_start_time") if conn is not None else None
+        if starts and starts[-1][0] is exception_context.execution_context:
+            starts.pop()
+
+
+def _pool_config() -> dict[str, Any]:
+    """Returns the connection pool settings shared by the primary and replicas."""
     if os.getenv("TRAMPOLINE_CI", None):
         logger.info("Using NullPool for testing")
         db_config: dict[str, Any] = {"poolclass": NullPool}
     else:
         db_config: dict[str, Any] = {
+            # Times checkout waits and supports resizing, see pool_monitor.py
+            "poolclass": pool_monitor.InstrumentedQueuePool,
             # Pool size is the maximum number of permanent connections to keep.
             "pool_size": 5,
             # Temporarily exceeds the set pool_size if no connections are available.
@@ -61,20 +232,109 @@ def init_connection_engine() -> sqlalchemy.engine.base.Engine:
             # reestablished
             "pool_recycle": 1800,  # 30 minutes
         }
+    return db_config
+
+
+def init_connection_engine() -> sqlalchemy.engine.base.Engine:
+    """Initializes a connection pool for a Cloud SQL instance of PostgreSQL.
+
+    Set `DATABASE_URL` to point at any other SQLAlchemy backend instead, e.g. a
+    local SQLite file or Postgres server for benchmarking.
+
+    Returns:
+        A SQLAlchemy Engine instance.
+    """
+    db_config = _pool_config()
 
-    if os.environ.get("DB_HOST"):
-        return init_tcp_connection_engine(db_config)
+    if os.environ.get("DATABASE_URL"):
+        factory = ENGINE_FACTORIES["url"]
+    elif os.environ.get("DB_HOST"):
+        factory = ENGINE_FACTORIES["tcp"]
     else:
-        return init_unix_connection_engine(db_config)
+        factory = ENGINE_FACTORIES["unix"]
+
+    engine = factory(db_config)
+    instrument_engine(engine)
+    pool_monitor.monitor(engine, "primary")
+    return engine
+
+
+def init_replica_engines() -> list[sqlalchemy.engine.base.Engine]:
+    """Initializes a connection pool for each configured read replica.
+
+    Replicas are listed as comma separated URLs in `DATABASE_REPLICA_URLS` when
+    `DATABASE_URL` is used, otherwise as comma separated `host:port` pairs in the
+    `DB_REPLICA_HOSTS` credential.
+
+    Returns:
+        A list of SQLAlchemy Engine instances, empty if no replicas are configured.
+    """
+    db_config = _pool_config()
+    # Check connections on checkout so a failed replica is noticed straight away
+    db_config["pool_pre_ping"] = True
+
+    if os.environ.get("DATABASE_URL"):
+        urls = os.environ.get("DATABASE_REPLICA_URLS") or ""
+        engines = [
+            init_url_connection_engine(db_config, url=url.strip())
+            for url in urls.split(",")
+            if url.strip()
+        ]
+    else:
+        hosts = credentials.get_cred_config().get("DB_REPLICA_HOSTS") or ""
+        engines = [
+            init_tcp_connection_engine(db_config, db_host=host.strip())
+            for host in hosts.split(",")
+            if host.strip()
+        ]
+
+    for index, engine in enumerate(engines):
+        instrument_engine(engine)
+        pool_monitor.monitor(engine, f"replica-{index}")
+    if engines:
+        logger.info(f"Initialized {len(engines)} read replica engines")
+    return engines
+
+
+def _driver_name(creds: dict[str, str]) -> str:
+    """Returns the configured PostgreSQL DBAPI driver, defaulting to pg8000."""
+    driver = creds.get("DB_DRIVER") or "pg8000"
+    if driver not in DRIVER_CONNECT_ARGS:
+        raise ValueError(f"Unsupported DB_DRIVER '{driver}'")
+    return driver
+
+
+def init_url_connection_engine(
+    db_config: dict[str, Any], url: str | None = None
+) -> sqlalchemy.engine.base.Engine:
+    """Initializes a connection pool from the `DATABASE_URL` environment variable.
+
+    Args:
+        db_config: a dictionary with connection pool config
+        url: connect to this URL instead of `DATABASE_URL`
+
+    Returns:
+        A SQLAlchemy Engine instance.
+    """
+    url = sqlalchemy.engine.make_url(url or os.environ["DATABASE_URL"])
+    if url.get_backend_name() == "sqlite":
+        # SQLite has no use for the Cloud SQL pool sizing
+        db_config = {k: v for k, v in db_config.items() if k == "poolclass"}
+
+    pool = sqlalchemy.create_engine(url, **db_config)
+    logger.info(f"Database engine initialized from url for {url.get_backend_name()}")
+
+    return pool
 
 
 def init_tcp_connection_engine(
-    db_config: dict[str, type[NullPool]]
+    db_config: dict[str, type[NullPool]], db_host: str | None = None
 ) -> sqlalchemy.engine.base.Engine:
     """Initializes a TCP connection pool for a Cloud SQL instance of PostgreSQL.
 
     Args:
         db_config: a dictionary with connection pool config
+        db_host: connect to this `host:port` instead of the `DB_HOST` credential
 
     Returns:
         A SQLAlchemy Engine instance.
@@ -83,7 +343,8 @@ def init_tcp_connection_engine(
     db_user = creds["DB_USER"]
     db_pass = creds["DB_PASSWORD"]
     db_name = creds["DB_NAME"]
-    db_host = creds["DB_HOST"]
+    db_host = db_host or creds["DB_HOST"]
+    driver = _driver_name(creds)
 
     # Extract host and port from db_host
     host_args = db_host.split(":")
@@ -91,19 +352,20 @@ def init_tcp_connection_engine(
 
     pool = sqlalchemy.create_engine(
         # Equivalent URL:
-        # postgres+pg8000://<db_user>:<db_pass>@<db_host>:<db_port>/<db_name>
+        # postgres+<driver>://<db_user>:<db_pass>@<db_host>:<db_port>/<db_name>
         sqlalchemy.engine.url.URL.create(
-            drivername="postgresql+pg8000",
+            drivername=f"postgresql+{driver}",
             username=db_user,  # e.g. "my-database-user"
             password=db_pass,  # e.g. "my-database-password"
             host=db_hostname,  # e.g. "127.0.0.1"
             port=db_port,  # e.g. 5432
             database=db_name,  # e.g. "my-database-name"
         ),
+        connect_args=DRIVER_CONNECT_ARGS[driver],
         **db_config,
     )
     pool.dialect.description_encoding = None
-    logger.info("Database engine initialized from tcp connection")
+    logger.info(f"Database engine initialized from tcp connection using {driver}")
 
     return pool
 
@@ -126,105 +388,154 @@ def init_unix_connection_engine(
     db_name = creds["DB_NAME"]
     db_socket_dir = creds.get("DB_SOCKET_DIR", "/cloudsql")
     cloud_sql_connection_name = creds["CLOUD_SQL_CONNECTION_NAME"]
+    driver = _driver_name(creds)
+    socket_path = f"{db_socket_dir}/{cloud_sql_connection_name}"
+
+    if driver == "pg8000":
+        # e.g. "/cloudsql", "<PROJECT-NAME>:<INSTANCE-REGION>:<INSTANCE-NAME>"
+        query = {"unix_sock": f"{socket_path}/.s.PGSQL.5432"}
+    else:
+        # libpq based drivers take the socket directory as the host
+        query = {"host": socket_path}
 
     pool = sqlalchemy.create_engine(
         # Equivalent URL:
         # postgres+pg8000://<db_user>:<db_pass>@/<db_name>
         #                         ?unix_sock=<socket_path>/<cloud_sql_instance_name>/.s.PGSQL.5432
         sqlalchemy.engine.url.URL.create(
-            drivername="postgresql+pg8000",
+            drivername=f"postgresql+{driver}",
             username=db_user,  # e.g. "my-database-user"
             password=db_pass,  # e.g. "my-database-password"
             database=db_name,  # e.g. "my-database-name"
-            query={
-                "unix_sock": f"{db_socket_dir}/{cloud_sql_connection_name}/.s.PGSQL.5432"
-                # e.g. "/cloudsql", "<PROJECT-NAME>:<INSTANCE-REGION>:<INSTANCE-NAME>"
-            },
+            query=query,
         ),
+        connect_args=DRIVER_CONNECT_ARGS[driver],
         **db_config,
     )
     pool.dialect.description_encoding = None
-    logger.info("Database engine initialized from unix connection")
+    logger.info(f"Database engine initialized from unix connection using {driver}")
 
     return pool
 
 
 # [END cloudrun_user_auth_sql_connect]
 
+ENGINE_FACTORIES: dict[str, Callable[[dict[str, Any]], sqlalchemy.engine.base.Engine]] = {
+    "url": init_url_connection_engine,
+    "tcp": init_tcp_connection_engine,
+    "unix": init_unix_connection_engine,
+}
+
+
+def _connect_to_replica() -> sqlalchemy.engine.Connection | None:
+    """Connects to the next healthy replica, or returns None if there isn't one."""
+    if not replicas:
+        return None
+    start = next(_replica_counter)
+    for offset in range(len(replicas)):
+        index = (start + offset) % len(replicas)
+        if _replica_down_until.get(index, 0) > time.monotonic():
+            continue
+        try:
+            return replicas[index].connect()
+        except (sqlalchemy.exc.DBAPIError, sqlalchemy.exc.TimeoutError) as e:
+            _replica_down_until[index] = time.monotonic() + REPLICA_RETRY_SECONDS
+            logger.warning(f"Read replica {index} unavailable, skipping it: {e}")
+    return None
+
+
+a = TypeVar("a")
+
+
+@contextlib.contextmanager
+def read_connection(allow_stale: bool = True) -> Iterator[sqlalchemy.engine.Connection]:
+    """Connection for read-only queries.
+
+    Args:
+        allow_stale: whether the caller can tolerate replication lag. If so the
+            query goes to a replica, falling back to the primary when none are
+            healthy. Otherwise it always goes to the primary.
+    """
+    conn = _connect_to_replica() if allow_stale else None
+    if conn is None:
+        conn = db.connect()
+    with conn:
+        yield conn
+
+
+def _read(query: Callable[[sqlalchemy.engine.Connection], a], allow_stale: bool) -> a:
+    """Runs the read-only `query`, once more on the primary if it fails on a replica.
+
+    Replicas can also fail after connecting: the server goes away, a pooled
+    connection has gone stale or a recovery conflict cancels the query.
+    """
+    with read_connection(allow_stale) as conn:
+        if conn.engine is db:
+            return query(conn)
+        try:
+            return query(conn)
+        except sqlalchemy.exc.DBAPIError as e:
+            logger.warning(f"Query failed on a read replica, retrying on the primary: {e}")
+    with db.connect() as conn:
+        return query(conn)
+
 
 def create_tables() -> None:
-    """Initializes SQLAlchemy connection and creates database table."""
+    """Initializes the SQLAlchemy connections and checks the schema is up to date."""
     # This is called before any request on the main app, ensuring the database has been setup
-    logger.info("Creating tables")
-    global db
+    global db, replicas
     db = init_connection_engine()
-    # Create pet_votes table if it doesn't already exist
-    with db.begin() as conn:
-        conn.execute(
-            sqlalchemy.text(
-                "CREATE TABLE IF NOT EXISTS pet_votes"
-                "( vote_id SERIAL NOT NULL, "
-                "time_cast timestamp NOT NULL, "
-                "candidate VARCHAR(6) NOT NULL, "
-                "uid VARCHAR(128) NOT NULL, "
-                "PRIMARY KEY (vote_id)"
-                ");"
-            )
-        )
-        conn.execute(
-            sqlalchemy.text(
-                "CREATE TABLE IF NOT EXISTS active_users"
-                "( user_id SERIAL NOT NULL, "
-                "username VARCHAR(128) NOT NULL, "
-                "tokens INTEGER NOT NULL DEFAULT 0, "
-                "PRIMARY KEY (user_id), "
-                "UNIQUE (username)"
-                ");"
-            )
-        )
+    # Migrations are applied by `python migrations.py` before the server starts,
+    # not here where they would hold up the first request
+    pending = migrations.pending_versions(db)
+    if pending:
+        logger.error(f"Schema migrations {pending} are pending, run `python migrations.py`")
+    migrations.maintain_vote_partitions(db)
+    replicas = init_replica_engines()
 
 
-def initialise_user_if_required(uid: str):
-    # Check if the user already exists in the active_users table
-    with db.connect() as conn:
-        user_exists = conn.execute(
-            sqlalchemy.text(
-                "SELECT COUNT(*) FROM active_users WHERE username=:username"
-            ),
-            parameters={"username": uid},
-        ).scalar()
+def initialise_user_if_required(uid: str, allow_stale: bool = True) -> bool:
+    """Gives a new user their initial token supply.
+
+    Returns:
+        True if the user was created by this call.
+    """
+    # Check if the user already exists in the active_users table. A stale replica
+    # at worst sends us to the INSERT below, which tolerates the user existing.
+    user_exists = _read(
+        lambda conn: conn.execute(_user_exists_stmt, parameters={"username": uid}).scalar(),
+        allow_stale,
+    )
 
     # If the user doesn't exist, insert a new row with an initial token supply
     if not user_exists:
         try:
             with db.begin() as conn:
                 conn.execute(
-                    sqlalchemy.text(
-                        "INSERT INTO active_users (username, tokens) VALUES (:username, :tokens)"
-                    ),
+                    _insert_user_stmt,
                     parameters={"username": uid, "tokens": 100}  # Set an initial token supply
                 )
+            return True
         except IntegrityError:
             # Handle potential concurrent insertions by catching IntegrityError
             # This can happen if another process/thread inserted the same username
             # between our SELECT and INSERT queries
             pass
+    return False
 
-def get_index_context() -> dict[str, Any]:
+def get_index_context(allow_stale: bool = True) -> dict[str, Any]:
     """Query PostgreSQL database and transform data for UI.
 
+    Args:
+        allow_stale: whether the data may be read from a lagging replica
+
     Returns:
         A dictionary of counts and votes.
     """
     votes = []
-    with db.connect() as conn:
+    with read_connection(allow_stale) as conn:
         # Execute the query and fetch all results
-        recent_votes = conn.execute(
-            sqlalchemy.text(
-                "SELECT candidate, time_cast FROM pet_votes "
-                "ORDER BY time_cast DESC LIMIT 5"
-            )
-        ).fetchall()
+        recent_votes = conn.execute(_recent_votes_stmt).fetchall()
         # Convert the results into a list of dicts representing votes
         for row in recent_votes:
             votes.append(
@@ -233,13 +544,14 @@ def get_index_context() -> dict[str, Any]:
                     "time_cast": row[1],
                 }
             )
-        stmt = sqlalchemy.text(
-            "SELECT COUNT(vote_id) FROM pet_votes WHERE candidate=:candidate"
-        )
         # Count number of votes for cats
-        cats_count = conn.execute(stmt, parameters={"candidate": "CATS"}).scalar()
+        cats_count = conn.execute(
+            _candidate_count_stmt, parameters={"candidate": "CATS"}
+        ).scalar()
         # Count number of votes for dogs
-        dogs_count = conn.execute(stmt, parameters={"candidate": "DOGS"}).scalar()
+        dogs_count = conn.execute(
+            _candidate_count_stmt, parameters={"candidate": "DOGS"}
+        ).scalar()
     return {
         "dogs_count": dogs_count,
         "recent_votes": votes,
@@ -249,54 +561,286 @@ def get_index_context() -> dict[str, Any]:
 def set_user_tokens(uid: str, amount: int) -> int:
     with db.begin() as conn:
         conn.execute(
-            sqlalchemy.text(
-                "UPDATE active_users SET tokens=:amount WHERE username=:username"
-            ),
-            parameters={"amount": amount, "username": uid},
+            _set_tokens_stmt, parameters={"amount": amount, "uid": uid}
         )
+    get_cache("tokens").delete(uid)
 
 def add_tokens_to_user(uid: str, amount: int) -> int:
     """Add tokens to a user's token balance."""
     with db.begin() as conn:
-        # Get the current token count for the user
-        current_tokens = conn.execute(
-            sqlalchemy.text(
-                "SELECT tokens FROM active_users WHERE username=:username"
-            ),
-            parameters={"username": uid},
+        # Increment in place so concurrent debits can't overwrite each other
+        new_tokens = conn.execute(
+            _add_tokens_stmt, parameters={"amount": amount, "uid": uid}
         ).scalar()
 
-        if current_tokens is not None:
-            # Calculate the new token count
-            # new_tokens = max(current_tokens + amount, 0)
-            new_tokens = current_tokens + amount
-
-            # Update the user's token count in the database
-            conn.execute(
-                sqlalchemy.text(
-                    "UPDATE active_users SET tokens=:new_tokens WHERE username=:username"
-                ),
-                parameters={"new_tokens": new_tokens, "username": uid},
-            )
-            return new_tokens
-        else:
-            # User not found in active_users table
-            raise ValueError(f"User '{uid}' not found.")
+    if new_tokens is None:
+        # User not found in active_users table
+        raise ValueError(f"User '{uid}' not found.")
+    get_cache("tokens").set(uid, new_tokens)
+    return new_tokens
+
+def get_tokens_for_uid(uid: str, allow_stale: bool = True) -> int:
+    """Fetch the token count for a given user.
+
+    Pass `allow_stale=False` when the balance must reflect a write just made.
+    """
+    if not allow_stale:
+        return _read_tokens(uid, allow_stale=False)
+
+    cached_tokens = get_cache("tokens").get(uid)
+    if cached_tokens is not None:
+        return cached_tokens
+    return _read_stale_tokens(uid)
+
+
+def _read_tokens(uid: str, allow_stale: bool) -> int | None:
+    row = _read(
+        lambda conn: conn.execute(_select_tokens_stmt, parameters={"username": uid}).fetchone(),
+        allow_stale,
+    )
+    if row:
+        get_cache("tokens").set(uid, row[0])
+        return row[0]
+    if allow_stale:
+        # A user created moments ago may not have reached the replica yet
+        return _read_tokens(uid, allow_stale=False)
+    return None  # User not found in active_users table
+
+
+# Concurrent lookups of the same balance share one query. Reads that must see a
+# write just made don't join, as the shared query may have started before it.
+@single_flight("tokens")
+def _read_stale_tokens(uid: str) -> int | None:
+    return _read_tokens(uid, allow_stale=True)
+
+
+BulkTokenMode = Literal["delta", "absolute"]
+
+# Users updated per transaction by the bulk token functions. Each chunk commits on
+# its own, which bounds the statement size and how long row locks are held.
+BULK_TOKENS_CHUNK_SIZE = 1000
+
+# Missing uids listed in a bulk summary, beyond this only the count is kept
+BULK_TOKENS_MAX_REPORTED_MISSING = 100
+
+
+class BulkTokenSummary(NamedTuple):
+    mode: str
+    # Distinct uids requested, or None when users were selected by a predicate
+    requested: int | None
+    updated: int
+    # Requested uids that aren't in active_users, and the first few of them
+    missing: int
+    missing_uids: list[str]
+    chunks: int
+    elapsed_ms: float
+
+
+class BulkTokenError(Exception):
+    """Raised when a chunk of a bulk token update fails.
+
+    The chunks before it stay committed; `summary` describes what was applied.
+    """
+
+    def __init__(self, message: str, summary: BulkTokenSummary) -> None:
+        super().__init__(message)
+        self.summary = summary
+
+
+def _check_mode(mode: str) -> None:
+    if mode not in ("delta", "absolute"):
+        raise ValueError(f"Unsupported bulk token mode '{mode}'")
+
+
+def _new_tokens(mode: BulkTokenMode, amount: Any) -> Any:
+    return active_users.c.tokens + amount if mode == "delta" else amount
+
+
+def token_predicate(where: dict[str, Any]) -> sqlalchemy.ColumnElement[bool]:
+    """Builds a filter on active_users from a JSON-friendly predicate.
+
+    Supported keys, combined with AND: `uid_prefix`, `tokens_below` and
+    `tokens_above`. An empty predicate matches every user.
+
+    Raises:
+        ValueError: for unknown keys or malformed values.
+    """
+    unknown = set(where) - {"uid_prefix", "tokens_below", "tokens_above"}
+    if unknown:
+        raise ValueError(f"Unsupported predicate keys: {', '.join(sorted(unknown))}")
+    clauses = [sqlalchemy.true()]
+    if "uid_prefix" in where:
+        clauses.append(
+            active_users.c.username.startswith(str(where["uid_prefix"]), autoescape=True)
+        )
+    if "tokens_below" in where:
+        clauses.append(active_users.c.tokens < int(where["tokens_below"]))
+    if "tokens_above" in where:
+        clauses.append(active_users.c.tokens > int(where["tokens_above"]))
+    return sqlalchemy.and_(*clauses)
+
+
+def _apply_token_chunk(
+    conn: sqlalchemy.engine.Connection, chunk: dict[str, int], mode: BulkTokenMode
+) -> list[sqlalchemy.Row]:
+    """Updates every user in `chunk` with a single UPDATE ... FROM statement."""
+    staged = conn.dialect.name != "postgresql"
+    if staged:
+        _token_changes.create(conn)
+        conn.execute(
+            _token_changes.insert(),
+            [{"uid": uid, "amount": amount} for uid, amount in chunk.items()],
+        )
+        changes = _token_changes
+    else:
+        changes = sqlalchemy.values(
+            sqlalchemy.column("uid", sqlalchemy.String),
+            sqlalchemy.column("amount", sqlalchemy.Integer),
+            name="changes",
+        ).data(list(chunk.items()))
+
+    amount = sqlalchemy.cast(changes.c.amount, sqlalchemy.Integer)
+    rows = conn.execute(
+        active_users.update()
+        .where(active_users.c.username == changes.c.uid)
+        .values(tokens=_new_tokens(mode, amount))
+        .returning(active_users.c.username, active_users.c.tokens)
+    ).all()
+    if staged:
+        _token_changes.drop(conn)
+    return rows
+
+
+def _cache_balances(rows: list[sqlalchemy.Row]) -> None:
+    tokens_cache = get_cache("tokens")
+    for uid, tokens in rows:
+        tokens_cache.set(uid, tokens)
+
+
+def bulk_update_tokens(
+    changes: Iterable[tuple[str, int]],
+    mode: BulkTokenMode = "delta",
+    chunk_size: int = BULK_TOKENS_CHUNK_SIZE,
+) -> BulkTokenSummary:
+    """Applies token changes for many users with one set-based UPDATE per chunk.
+
+    On PostgreSQL each chunk is joined against an inline `VALUES` list, elsewhere
+    against a temporary staging table.
+
+    Args:
+        changes: (uid, amount) pairs
+        mode: "delta" adds the amounts to the balances, adding up repeated uids;
+            "absolute" replaces the balances, and the last amount for a uid wins
+        chunk_size: users updated per transaction
+
+    Raises:
+        ValueError: for an unsupported mode.
+        BulkTokenError: if a chunk fails, after the earlier chunks were committed.
+    """
+    _check_mode(mode)
+    start = time.perf_counter()
+    merged: dict[str, int] = {}
+    for uid, amount in changes:
+        merged[uid] = merged.get(uid, 0) + amount if mode == "delta" else amount
+    uids = list(merged)
+
+    updated = 0
+    missing: list[str] = []
+    chunks = 0
+
+    def summary() -> BulkTokenSummary:
+        return BulkTokenSummary(
+            mode=mode,
+            requested=len(uids),
+            updated=updated,
+            missing=len(missing),
+            missing_uids=missing[:BULK_TOKENS_MAX_REPORTED_MISSING],
+            chunks=chunks,
+            elapsed_ms=round((time.perf_counter() - start) * 1000, 1),
+        )
+
+    for offset in range(0, len(uids), chunk_size):
+        chunk = {uid: merged[uid] for uid in uids[offset:offset + chunk_size]}
+        try:
+            with db.begin() as conn:
+                rows = _apply_token_chunk(conn, chunk, mode)
+        except Exception as e:
+            raise BulkTokenError(f"Bulk token update failed in chunk {chunks + 1}: {e}", summary()) from e
+        _cache_balances(rows)
+        found = {row[0] for row in rows}
+        missing.extend(uid for uid in chunk if uid not in found)
+        updated += len(rows)
+        chunks += 1
+
+    result = summary()
+    logger.info("bulk token update", **result._asdict())
+    return result
+
+
+def bulk_update_tokens_where(
+    where: dict[str, Any],
+    amount: int,
+    mode: BulkTokenMode = "delta",
+    chunk_size: int = BULK_TOKENS_CHUNK_SIZE,
+) -> BulkTokenSummary:
+    """Applies one token change to every user matching a predicate.
+
+    Users are updated in chunks of consecutive user ids, one transaction each.
+    Users created after the update starts may be left out.
+
+    Args:
+        where: a predicate for `token_predicate`
+        amount: tokens to add ("delta") or the new balance ("absolute")
+        mode: "delta" or "absolute"
+        chunk_size: span of user ids updated per transaction
+
+    Raises:
+        ValueError: for an unsupported mode or predicate.
+        BulkTokenError: if a chunk fails, after the earlier chunks were committed.
+    """
+    _check_mode(mode)
+    new_tokens = _new_tokens(mode, amount)
+    predicate = token_predicate(where)
+    start = time.perf_counter()
+    updated = 0
+    chunks = 0
+
+    def summary() -> BulkTokenSummary:
+        return BulkTokenSummary(
+            mode=mode,
+            requested=None,
+            updated=updated,
+            missing=0,
+            missing_uids=[],
+            chunks=chunks,
+            elapsed_ms=round((time.perf_counter() - start) * 1000, 1),
+        )
 
-def get_tokens_for_uid(uid: str) -> int:
-    """Fetch the token count for a given user."""
     with db.connect() as conn:
-        result = conn.execute(
-            sqlalchemy.text(
-                "SELECT tokens FROM active_users WHERE username=:username"
-            ),
-            parameters={"username": uid},
+        low, high = conn.execute(_user_id_range_stmt).one()
+    for chunk_start in range(low, high + 1, chunk_size) if low is not None else ():
+        stmt = (
+            active_users.update()
+            .where(
+                predicate,
+                active_users.c.user_id >= chunk_start,
+                active_users.c.user_id < chunk_start + chunk_size,
+            )
+            .values(tokens=new_tokens)
+            .returning(active_users.c.username, active_users.c.tokens)
         )
-        row = result.fetchone()
-        if row:
-            return row[0]
-        else:
-            return None  # User not found in active_users table
+        try:
+            with db.begin() as conn:
+                rows = conn.execute(stmt).all()
+        except Exception as e:
+            raise BulkTokenError(f"Bulk token update failed in chunk {chunks + 1}: {e}", summary()) from e
+        _cache_balances(rows)
+        updated += len(rows)
+        chunks += 1
+
+    result = summary()
+    logger.info("bulk token update", where=where, **result._asdict())
+    return result
 
 
 def save_vote(team: str, uid: str, time_cast: datetime.datetime) -> None:
@@ -307,17 +851,12 @@ def save_vote(team: str, uid: str, time_cast: datetime.datetime) -> None:
         uid: the user id
         time_cast: the time of the vote
     """
-    # Preparing a statement before hand can help protect against injections.
-    stmt = sqlalchemy.text(
-        "INSERT INTO pet_votes (time_cast, candidate, uid)"
-        " VALUES (:time_cast, :candidate, :uid)"
-    )
-
     # Using a with statement ensures that the connection is always released
     # back into the pool at the end of statement (even if an error occurs)
     with db.begin() as conn:
         conn.execute(
-            stmt, parameters={"time_cast": time_cast, "candidate": team, "uid": uid}
+            _insert_vote_stmt,
+            parameters={"time_cast": time_cast, "candidate": team, "uid": uid},
         )
     logger.info("Vote for %s saved.", team)
 
@@ -332,3 +871,5 @@ def shutdown() -> None:
     if db:
         db.dispose()
         logger.info("Database connection disposed.")
+    for replica in replicas:
+        replica.dispose()
@@ -0,0 +1,187 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pathlib
+import uuid
+
+import pytest
+import sqlalchemy
+
+import database
+
+
+@pytest.fixture
+def lagging_replica(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A primary and a replica that hasn't received any rows yet."""
+    primary = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    replica = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    database.metadata.create_all(primary)
+    database.metadata.create_all(replica)
+    monkeypatch.setattr(database, "db", primary)
+    monkeypatch.setattr(database, "replicas", [replica])
+
+
+@pytest.mark.usefixtures("lagging_replica")
+def test_new_user_balance_falls_back_to_primary() -> None:
+    uid = uuid.uuid4().hex
+    assert database.initialise_user_if_required(uid)
+    assert database.get_tokens_for_uid(uid) == 100
+
+
+@pytest.mark.usefixtures("lagging_replica")
+def test_unknown_user_has_no_balance() -> None:
+    assert database.get_tokens_for_uid(uuid.uuid4().hex) is None
+
+
+@pytest.mark.usefixtures("lagging_replica")
+def test_replica_pool_timeout_falls_back_to_primary(monkeypatch: pytest.MonkeyPatch) -> None:
+    def connect() -> sqlalchemy.engine.Connection:
+        raise sqlalchemy.exc.TimeoutError("QueuePool limit reached")
+
+    monkeypatch.setattr(database.replicas[0], "connect", connect)
+    monkeypatch.setattr(database, "_replica_down_until", {})
+    with database.read_connection() as conn:
+        assert conn.engine is database.db
+
+
+@pytest.mark.usefixtures("lagging_replica")
+def test_replica_query_failure_retries_on_primary() -> None:
+    uid = uuid.uuid4().hex
+    assert database.initialise_user_if_required(uid)
+    database.get_cache("tokens").delete(uid)
+
+    @sqlalchemy.event.listens_for(database.replicas[0], "before_cursor_execute")
+    def fail(*args: object) -> None:
+        raise sqlalchemy.exc.OperationalError(
+            "SELECT", {}, Exception("canceling statement due to conflict with recovery")
+        )
+
+    assert database.get_tokens_for_uid(uid) == 100
+    assert not database.initialise_user_if_required(uid)
+
+
+@pytest.mark.usefixtures("lagging_replica")
+def test_primary_query_failure_is_raised() -> None:
+    @sqlalchemy.event.listens_for(database.db, "before_cursor_execute")
+    def fail(*args: object) -> None:
+        raise sqlalchemy.exc.OperationalError("SELECT", {}, Exception("server closed the connection"))
+
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        database.get_tokens_for_uid(uuid.uuid4().hex, allow_stale=False)
+
+
+@pytest.fixture
+def users(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """Five users with 100 tokens each in a fresh primary, with no replicas."""
+    primary = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    database.metadata.create_all(primary)
+    monkeypatch.setattr(database, "db", primary)
+    monkeypatch.setattr(database, "replicas", [])
+    prefix = uuid.uuid4().hex[:8]
+    uids = [f"{prefix}-{i}" for i in range(5)]
+    for uid in uids:
+        database.initialise_user_if_required(uid)
+    return uids
+
+
+def balances() -> dict[str, int]:
+    with database.db.connect() as conn:
+        rows = conn.execute(
+            sqlalchemy.select(database.active_users.c.username, database.active_users.c.tokens)
+        ).all()
+    return dict(rows)
+
+
+def test_bulk_deltas_to_the_same_uid_add_up(users: list[str]) -> None:
+    summary = database.bulk_update_tokens([(users[0], 5), (users[1], -20), (users[0], 7)])
+
+    assert summary.requested == 2
+    assert summary.updated == 2
+    assert balances()[users[0]] == 112
+    assert balances()[users[1]] == 80
+    assert balances()[users[2]] == 100
+
+
+def test_bulk_absolute_last_amount_wins(users: list[str]) -> None:
+    database.bulk_update_tokens([(users[0], 5), (users[0], 30)], mode="absolute")
+    assert balances()[users[0]] == 30
+
+
+def test_bulk_reports_unknown_uids(users: list[str]) -> None:
+    summary = database.bulk_update_tokens([(users[0], 1), ("ghost", 1)])
+
+    assert summary.updated == 1
+    assert summary.missing == 1
+    assert summary.missing_uids == ["ghost"]
+    assert "ghost" not in balances()
+
+
+def test_bulk_update_spans_chunks(users: list[str]) -> None:
+    summary = database.bulk_update_tokens([(uid, 1) for uid in users], chunk_size=2)
+
+    assert summary.chunks == 3
+    assert summary.updated == 5
+    assert all(balances()[uid] == 101 for uid in users)
+
+
+def test_bulk_update_caches_new_balances(users: list[str]) -> None:
+    database.bulk_update_tokens([(users[0], 50)])
+    assert database.get_cache("tokens").get(users[0]) == 150
+
+
+def test_bulk_unsupported_mode(users: list[str]) -> None:
+    with pytest.raises(ValueError):
+        database.bulk_update_tokens([(users[0], 1)], mode="multiply")
+
+
+def test_bulk_where_only_touches_matching_users(users: list[str]) -> None:
+    database.set_user_tokens(users[0], 3)
+    database.initialise_user_if_required("someone-else")
+
+    summary = database.bulk_update_tokens_where(
+        {"uid_prefix": users[0].split("-")[0], "tokens_below": 10}, 50, mode="absolute"
+    )
+    assert summary.updated == 1
+    assert balances()[users[0]] == 50
+    assert balances()[users[1]] == 100
+    assert balances()["someone-else"] == 100
+
+
+def test_bulk_where_spans_chunks(users: list[str]) -> None:
+    summary = database.bulk_update_tokens_where({}, -10, chunk_size=2)
+
+    assert summary.chunks == 3
+    assert summary.updated == 5
+    assert set(balances().values()) == {90}
+
+
+def test_bulk_where_rejects_unknown_keys(users: list[str]) -> None:
+    with pytest.raises(ValueError):
+        database.bulk_update_tokens_where({"username": "x"}, 1)
+
+
+def test_failed_statements_leave_no_timings_behind() -> None:
+    engine = sqlalchemy.create_engine("sqlite://")
+    database.instrument_engine(engine)
+    with engine.connect() as conn:
+        for _ in range(3):
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                conn.exec_driver_sql("SELECT * FROM missing_table")
+        assert conn.info["query_start_time"] == []
+
+        database.begin_query_stats()
+        conn.exec_driver_sql("SELECT 1")
+        stats = database.end_query_stats()
+        assert conn.info["query_start_time"] == []
+    assert stats.count == 1
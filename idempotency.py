@@ -0,0 +1,199 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Idempotency-Key support, so client retries don't repeat work or charges.
+
+The first request with a given key (per user and route) runs normally and its
+response is stored in the `idempotency` cache namespace; retries get the stored
+response back. Answer audio is too large for that namespace, so routes set
+`g.idempotent_audio_text` (and `g.idempotent_audio_model`, if not the default)
+and the audio is kept in the `answer_audio` namespace; should it be evicted
+before a retry, it is synthesized again from the text. A duplicate that arrives
+while the original is still running waits for it. Responses with a 5xx status
+aren't stored, so those can be retried. Side effects that must not be repeated
+by such a retry, like debiting tokens, are run through `once`.
+
+The original claims its key with an atomic `add`, so with the `shared` or
+`redis` cache backend duplicates are detected across workers and hosts too. With
+the `memory` backend they're only detected within one worker.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Callable
+from functools import wraps
+from typing import TypeVar
+
+from flask import Response, g, request
+
+from cache import CacheBackend, get_cache, make_key
+from middleware import logger
+from parsing import text_to_speech
+
+a = TypeVar("a")
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# Set on replays of responses whose body was too large to keep
+BODY_OMITTED_HEADER = "Idempotent-Body-Omitted"
+MAX_KEY_LENGTH = 255
+
+# How long a duplicate waits for the original, and how often it checks on an
+# original running in another worker
+WAIT_SECONDS = 120
+POLL_INTERVAL_SECONDS = 0.1
+
+_in_flight: dict[str, threading.Event] = {}
+_in_flight_lock = threading.Lock()
+
+
+def _record(cache_key: str, response: Response) -> dict:
+    record = {
+        "status": response.status_code,
+        "content_type": response.content_type,
+        "headers": {
+            name: value for name, value in response.headers.items()
+            if name not in ("Content-Type", "Content-Length")
+        },
+    }
+    audio_text = g.get("idempotent_audio_text")
+    if audio_text is not None:
+        record["audio_text"] = audio_text
+        record["audio_model"] = g.get("idempotent_audio_model")
+        get_cache("answer_audio").set(cache_key, response.get_data())
+    else:
+        record["body"] = response.get_data()
+    return record
+
+
+def _store(store: CacheBackend, cache_key: str, response: Response) -> bool:
+    """Stores the response for retries, without its body if it's too large.
+
+    A retry must not run the request again once it has succeeded, so when the
+    whole response doesn't fit it still gets the status and headers.
+    """
+    record = _record(cache_key, response)
+    if store.set(cache_key, record):
+        return True
+    if "body" not in record:
+        return False
+    logger.warning(f"Response for idempotency key from {request.uid} is too large to store")
+    record["body"] = b""
+    record["headers"][BODY_OMITTED_HEADER] = "true"
+    return store.set(cache_key, record)
+
+
+def _replay(cache_key: str, record: dict) -> Response:
+    if "audio_text" in record:
+        body = get_cache("answer_audio").get(cache_key)
+        if body is None:
+            body = text_to_speech(record["audio_text"], record.get("audio_model"))
+    else:
+        body = record["body"]
+    response = Response(
+        response=body,
+        status=record["status"],
+        content_type=record["content_type"],
+        headers=record["headers"],
+    )
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def once(step: str, func: Callable[[], a]) -> a:
+    """Runs `func` at most once per Idempotency-Key, even across failed attempts.
+
+    A retry of a request that failed after `func` ran gets the first result back
+    instead of running it again. Without an Idempotency-Key `func` always runs.
+
+    Args:
+        step: names the side effect, unique within the route
+        func: the side effect, its result must be picklable
+    """
+    cache_key = g.get("idempotency_cache_key")
+    if cache_key is None:
+        return func()
+    store = get_cache("idempotency")
+    step_key = make_key(cache_key, step)
+    done = store.get(step_key)
+    if done is not None:
+        logger.info(f"Skipping {step} already done for idempotency key from {request.uid}")
+        return done["result"]
+    result = func()
+    if not store.set(step_key, {"result": result}):
+        logger.warning(f"Unable to record {step} for idempotency key from {request.uid}")
+    return result
+
+
+def idempotent(func: Callable[..., a]) -> Callable[..., a]:
+    """Makes a `jwt_authenticated` route honour the Idempotency-Key header."""
+
+    @wraps(func)
+    def decorated_function(*args: a, **kwargs: a) -> a:
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return func(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response(status=400, response="Idempotency-Key is too long")
+
+        store = get_cache("idempotency")
+        cache_key = make_key(request.uid, request.method, request.path, key)
+        deadline = time.monotonic() + WAIT_SECONDS
+        while True:
+            record = store.get(cache_key)
+            if record is not None and not record.get("pending"):
+                logger.info(f"Replaying response for idempotency key from {request.uid}")
+                return _replay(cache_key, record)
+
+            with _in_flight_lock:
+                event = _in_flight.get(cache_key)
+                # Claiming the key is atomic across workers sharing the cache,
+                # so only one of several concurrent duplicates runs
+                is_original = (
+                    event is None
+                    and record is None
+                    and store.add(cache_key, {"pending": True}, ttl=WAIT_SECONDS)
+                )
+                if is_original:
+                    event = _in_flight[cache_key] = threading.Event()
+            if is_original:
+                break
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return Response(status=409,
+                    response="A request with this Idempotency-Key is still in progress"
+                )
+            if event is not None:
+                event.wait(timeout=remaining)
+            else:
+                # The original is running in another worker
+                time.sleep(POLL_INTERVAL_SECONDS)
+
+        stored = False
+        g.idempotency_cache_key = cache_key
+        try:
+            response = func(*args, **kwargs)
+            if response.status_code < 500:
+                stored = _store(store, cache_key, response)
+            return response
+        finally:
+            if not stored:
+                store.delete(cache_key)
+            with _in_flight_lock:
+                _in_flight.pop(cache_key, None)
+            event.set()
+
+    return decorated_function
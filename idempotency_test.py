@@ -0,0 +1,168 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, g, request
+import pytest
+
+import idempotency
+from idempotency import BODY_OMITTED_HEADER, idempotent, once
+
+calls: list[str] = []
+debits: list[int] = []
+slow_started = threading.Event()
+slow_release = threading.Event()
+
+app = Flask(__name__)
+
+
+@app.before_request
+def authenticate() -> None:
+    # Stands in for jwt_authenticated
+    request.uid = "test-user"
+
+
+@app.route("/echo/", methods=["POST"])
+@idempotent
+def echo() -> Response:
+    calls.append("echo")
+    return Response(status=200, response=request.get_data())
+
+
+@app.route("/speak/", methods=["POST"])
+@idempotent
+def speak() -> Response:
+    calls.append("speak")
+    g.idempotent_audio_text = "answer"
+    # About a 100 word answer at 128kbps
+    return Response(status=200, response=b"\xff" * 700 * 1024, content_type="audio/mp3")
+
+
+@app.route("/slow/", methods=["POST"])
+@idempotent
+def slow() -> Response:
+    calls.append("slow")
+    slow_started.set()
+    slow_release.wait(timeout=5)
+    return Response(status=200, response=request.get_data())
+
+
+@app.route("/charge/", methods=["POST"])
+@idempotent
+def charge() -> Response:
+    calls.append("charge")
+    balance = once("debit", lambda: debits.append(1) or 100 - len(debits))
+    if len(calls) == 1 and request.args.get("fail_first"):
+        raise RuntimeError("text to speech failed after the debit")
+    return Response(status=200, response=str(balance))
+
+
+@pytest.fixture(autouse=True)
+def clear_calls() -> None:
+    calls.clear()
+    debits.clear()
+
+
+def post(path: str, key: str, body: bytes = b"hello") -> Response:
+    return app.test_client().post(path, data=body, headers={"Idempotency-Key": key})
+
+
+def test_retry_replays_response() -> None:
+    key = uuid.uuid4().hex
+    first = post("/echo/", key)
+    retry = post("/echo/", key)
+
+    assert calls == ["echo"]
+    assert retry.data == first.data == b"hello"
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+
+def test_oversized_response_is_replayed_without_body() -> None:
+    key = uuid.uuid4().hex
+    body = b"x" * 32 * 1024
+    assert post("/echo/", key, body).data == body
+
+    retry = post("/echo/", key, body)
+    assert calls == ["echo"]
+    assert retry.status_code == 200
+    assert retry.headers[BODY_OMITTED_HEADER] == "true"
+    assert retry.data == b""
+
+
+def test_retry_replays_answer_audio_without_synthesizing(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def text_to_speech(text: str, model: str | None = None) -> bytes:
+        raise AssertionError("replay synthesized the audio again")
+
+    monkeypatch.setattr(idempotency, "text_to_speech", text_to_speech)
+    key = uuid.uuid4().hex
+    first = post("/speak/", key)
+    retry = post("/speak/", key)
+
+    assert calls == ["speak"]
+    assert retry.data == first.data
+
+
+def test_duplicate_of_request_running_in_another_worker_waits(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(idempotency, "WAIT_SECONDS", 0.3)
+    key = uuid.uuid4().hex
+    # Another worker sharing the cache has claimed the key and is still running
+    cache_key = idempotency.make_key("test-user", "POST", "/echo/", key)
+    assert idempotency.get_cache("idempotency").add(cache_key, {"pending": True}, ttl=5)
+
+    response = post("/echo/", key)
+    assert response.status_code == 409
+    assert calls == []
+
+
+def test_retry_while_original_is_running_gets_its_response() -> None:
+    key = uuid.uuid4().hex
+    slow_started.clear()
+    slow_release.clear()
+    with ThreadPoolExecutor(2) as executor:
+        original = executor.submit(post, "/slow/", key)
+        assert slow_started.wait(timeout=5)
+        retry = executor.submit(post, "/slow/", key)
+        # Give the retry time to find the original in flight before it finishes
+        time.sleep(0.2)
+        assert not retry.done()
+        slow_release.set()
+
+    assert calls == ["slow"]
+    assert original.result().data == retry.result().data == b"hello"
+    assert retry.result().headers["Idempotent-Replayed"] == "true"
+
+
+def test_retry_after_failure_debits_once() -> None:
+    key = uuid.uuid4().hex
+    assert post("/charge/?fail_first=1", key).status_code == 500
+    retry = post("/charge/?fail_first=1", key)
+
+    assert calls == ["charge", "charge"]
+    assert debits == [1]
+    # The retry gets the balance from the first debit
+    assert retry.data == b"99"
+
+
+def test_without_key_every_request_debits() -> None:
+    app.test_client().post("/charge/")
+    app.test_client().post("/charge/")
+    assert debits == [1, 1]
@@ -0,0 +1,239 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Degrades answers gracefully while this worker is overloaded.
+
+The controller watches two kinds of signal: how many questions this worker is
+answering at once, and the recent 90th percentile latency of each upstream API
+(Whisper, the chat completion and TTS). Each signal has an "elevated" and a
+"saturated" threshold, configured as "elevated,saturated" strings:
+
+    LOAD_IN_FLIGHT              questions in progress (default from WORKER_THREADS)
+    LOAD_TRANSCRIBE_LATENCY_MS  Whisper latency (default "5000,10000")
+    LOAD_CHAT_LATENCY_MS        chat completion latency (default "4000,8000")
+    LOAD_TTS_LATENCY_MS         latency per synthesized chunk (default "3000,6000")
+
+A worker answers at most `WORKER_THREADS` (default 8, the `--threads` gunicorn
+is started with) questions at once, so by default the in-flight thresholds are
+three quarters of the threads and all of them. Set `WORKER_THREADS` wherever
+the thread count is changed, or questions are never counted as saturated.
+
+The load level rises as soon as any signal crosses a threshold, and only falls
+once every signal is back below `LOAD_RECOVERY_FACTOR` (default 0.8) of it, so it
+doesn't flap around a threshold. Each level maps to a `Degradation`: shorter
+answers, less chat context and a faster TTS model. Set `LOAD_CONTROL=0` to
+always answer at full quality.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from enum import IntEnum
+from functools import wraps
+from typing import NamedTuple, TypeVar
+
+from middleware import logger
+
+a = TypeVar("a")
+
+ENABLED = os.environ.get("LOAD_CONTROL", "1") != "0"
+# Must match gunicorn's --threads, it bounds the questions in progress per worker
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "8"))
+RECOVERY_FACTOR = float(os.environ.get("LOAD_RECOVERY_FACTOR", "0.8"))
+
+# Only upstream calls finished this recently count towards the latency signals
+LATENCY_WINDOW_SECONDS = 30
+LATENCY_WINDOW_SIZE = 200
+
+# A lower latency ElevenLabs model used while degraded
+TTS_FAST_MODEL = os.environ.get("TTS_FAST_MODEL", "eleven_turbo_v2")
+
+
+class Level(IntEnum):
+    NORMAL = 0
+    ELEVATED = 1
+    SATURATED = 2
+
+
+class Thresholds(NamedTuple):
+    elevated: float
+    saturated: float
+
+    def level_for(self, value: float, factor: float = 1.0) -> Level:
+        if value >= self.saturated * factor:
+            return Level.SATURATED
+        if value >= self.elevated * factor:
+            return Level.ELEVATED
+        return Level.NORMAL
+
+
+class Degradation(NamedTuple):
+    level: Level
+    # Longest answer, in words, that may be requested
+    max_response_length: int
+    # Most recent chat messages sent as context, kept even so turns stay paired
+    context_messages: int
+    # TTS model to synthesize with, None for the default
+    tts_model: str | None
+
+
+DEGRADATIONS: dict[Level, Degradation] = {
+    Level.NORMAL: Degradation(Level.NORMAL, 200, 10, None),
+    Level.ELEVATED: Degradation(Level.ELEVATED, 40, 6, TTS_FAST_MODEL),
+    Level.SATURATED: Degradation(Level.SATURATED, 20, 2, TTS_FAST_MODEL),
+}
+
+
+def _thresholds(name: str, default: str) -> Thresholds:
+    elevated, saturated = (float(value) for value in os.environ.get(name, default).split(","))
+    return Thresholds(elevated, saturated)
+
+
+def _default_in_flight(threads: int) -> str:
+    # Three quarters of the threads busy is elevated, all of them saturated
+    return f"{max(1, threads * 3 // 4)},{threads}"
+
+
+class LoadController:
+    """Tracks this worker's load and picks the degradation to answer with."""
+
+    def __init__(
+        self,
+        in_flight: Thresholds,
+        latency_ms: dict[str, Thresholds],
+        recovery_factor: float = RECOVERY_FACTOR,
+    ) -> None:
+        self.in_flight_thresholds = in_flight
+        self.latency_thresholds = latency_ms
+        self.recovery_factor = recovery_factor
+        self.level = Level.NORMAL
+        self._in_flight = 0
+        self._latencies: dict[str, deque[tuple[float, float]]] = {
+            upstream: deque(maxlen=LATENCY_WINDOW_SIZE) for upstream in latency_ms
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def enter(self) -> None:
+        with self._lock:
+            self._in_flight += 1
+
+    def exit(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def record_latency(self, upstream: str, seconds: float) -> None:
+        with self._lock:
+            self._latencies[upstream].append((time.monotonic(), seconds * 1000))
+
+    def latency_p90(self, upstream: str) -> float:
+        """Recent 90th percentile latency of `upstream` in ms, 0 if it hasn't been called."""
+        cutoff = time.monotonic() - LATENCY_WINDOW_SECONDS
+        with self._lock:
+            latencies = sorted(ms for at, ms in self._latencies[upstream] if at >= cutoff)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(0.9 * len(latencies)))]
+
+    def signals(self) -> dict[str, tuple[float, Thresholds]]:
+        """Every signal's current value with its thresholds."""
+        signals = {"in_flight": (float(self._in_flight), self.in_flight_thresholds)}
+        for upstream, thresholds in self.latency_thresholds.items():
+            signals[f"{upstream}_p90_ms"] = (self.latency_p90(upstream), thresholds)
+        return signals
+
+    def update(self) -> Level:
+        """Re-evaluates the load level from the current signals."""
+        signals = self.signals()
+        raised = max(thresholds.level_for(value) for value, thresholds in signals.values())
+        relaxed = max(
+            thresholds.level_for(value, self.recovery_factor)
+            for value, thresholds in signals.values()
+        )
+        with self._lock:
+            previous = self.level
+            if raised > previous:
+                self.level = raised
+            elif relaxed < previous:
+                self.level = relaxed
+            level = self.level
+        if level != previous:
+            logger.warning(
+                f"Load level changed from {previous.name} to {level.name}",
+                **{name: round(value, 1) for name, (value, _) in signals.items()},
+            )
+        return level
+
+    def degradation(self) -> Degradation:
+        """The degradation to answer the current question with."""
+        if not ENABLED:
+            return DEGRADATIONS[Level.NORMAL]
+        return DEGRADATIONS[self.update()]
+
+
+controller = LoadController(
+    in_flight=_thresholds("LOAD_IN_FLIGHT", _default_in_flight(WORKER_THREADS)),
+    latency_ms={
+        "transcribe": _thresholds("LOAD_TRANSCRIBE_LATENCY_MS", "5000,10000"),
+        "chat": _thresholds("LOAD_CHAT_LATENCY_MS", "4000,8000"),
+        "tts": _thresholds("LOAD_TTS_LATENCY_MS", "3000,6000"),
+    },
+)
+
+
+@contextlib.contextmanager
+def timed(upstream: str) -> Iterator[None]:
+    """Records how long a call to `upstream` takes, whether or not it succeeds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        controller.record_latency(upstream, time.perf_counter() - start)
+
+
+def tracked(func: Callable[..., a]) -> Callable[..., a]:
+    """Counts the decorated route's requests towards the in-flight signal."""
+
+    @wraps(func)
+    def decorated_function(*args: a, **kwargs: a) -> a:
+        controller.enter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            controller.exit()
+
+    return decorated_function
+
+
+def log_degradation(degradation: Degradation, requested_response_length: int) -> None:
+    """Logs how a question is being degraded, if at all."""
+    if degradation.level == Level.NORMAL:
+        return
+    logger.info(
+        "degraded answer",
+        load_level=degradation.level.name,
+        in_flight=controller.in_flight,
+        requested_response_length=requested_response_length,
+        response_length=min(requested_response_length, degradation.max_response_length),
+        context_messages=degradation.context_messages,
+        tts_model=degradation.tts_model,
+    )
@@ -0,0 +1,121 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import load_control
+from load_control import DEGRADATIONS, Level, LoadController, Thresholds
+
+
+@pytest.fixture
+def controller() -> LoadController:
+    return LoadController(
+        in_flight=Thresholds(6, 8),
+        latency_ms={"chat": Thresholds(4000, 8000)},
+        recovery_factor=0.8,
+    )
+
+
+def set_in_flight(controller: LoadController, count: int) -> Level:
+    while controller.in_flight < count:
+        controller.enter()
+    while controller.in_flight > count:
+        controller.exit()
+    return controller.update()
+
+
+def test_in_flight_levels_with_hysteresis(controller: LoadController) -> None:
+    assert set_in_flight(controller, 5) == Level.NORMAL
+    assert set_in_flight(controller, 6) == Level.ELEVATED
+    # Below the entry threshold but above 0.8 of it
+    assert set_in_flight(controller, 5) == Level.ELEVATED
+    assert set_in_flight(controller, 4) == Level.NORMAL
+
+
+def test_saturated_steps_down_through_elevated(controller: LoadController) -> None:
+    assert set_in_flight(controller, 8) == Level.SATURATED
+    assert set_in_flight(controller, 7) == Level.SATURATED
+    assert set_in_flight(controller, 6) == Level.ELEVATED
+    assert set_in_flight(controller, 5) == Level.ELEVATED
+    assert set_in_flight(controller, 3) == Level.NORMAL
+
+
+def test_rises_straight_to_saturated(controller: LoadController) -> None:
+    assert set_in_flight(controller, 9) == Level.SATURATED
+
+
+def record(controller: LoadController, ms: float) -> Level:
+    # Fills the latency window, so the 90th percentile is `ms`
+    for _ in range(load_control.LATENCY_WINDOW_SIZE):
+        controller.record_latency("chat", ms / 1000)
+    return controller.update()
+
+
+def test_latency_levels_with_hysteresis(controller: LoadController) -> None:
+    assert record(controller, 3900) == Level.NORMAL
+    assert record(controller, 4000) == Level.ELEVATED
+    assert record(controller, 3500) == Level.ELEVATED
+    assert record(controller, 9000) == Level.SATURATED
+    assert record(controller, 7000) == Level.SATURATED
+    assert record(controller, 3100) == Level.NORMAL
+
+
+def test_any_signal_holds_the_level(controller: LoadController) -> None:
+    set_in_flight(controller, 6)
+    assert record(controller, 5000) == Level.ELEVATED
+    # Latency recovered, but questions in progress haven't
+    assert record(controller, 1000) == Level.ELEVATED
+    assert set_in_flight(controller, 2) == Level.NORMAL
+
+
+def test_old_latencies_stop_counting(
+    controller: LoadController, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    now = [1000.0]
+    monkeypatch.setattr(load_control.time, "monotonic", lambda: now[0])
+    assert record(controller, 9000) == Level.SATURATED
+    now[0] += load_control.LATENCY_WINDOW_SECONDS + 1
+    assert controller.latency_p90("chat") == 0.0
+    assert controller.update() == Level.NORMAL
+
+
+def test_degradation_follows_level(
+    controller: LoadController, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    set_in_flight(controller, 6)
+    assert controller.degradation() == DEGRADATIONS[Level.ELEVATED]
+    assert controller.degradation().tts_model == load_control.TTS_FAST_MODEL
+    monkeypatch.setattr(load_control, "ENABLED", False)
+    assert controller.degradation() == DEGRADATIONS[Level.NORMAL]
+
+
+@pytest.mark.parametrize("threads, expected", [(8, "6,8"), (4, "3,4"), (1, "1,1")])
+def test_in_flight_defaults_from_worker_threads(threads: int, expected: str) -> None:
+    assert load_control._default_in_flight(threads) == expected
+
+
+def test_tracked_counts_questions_in_progress(monkeypatch: pytest.MonkeyPatch) -> None:
+    controller = LoadController(in_flight=Thresholds(1, 2), latency_ms={})
+    monkeypatch.setattr(load_control, "controller", controller)
+    seen = []
+
+    @load_control.tracked
+    def handler() -> None:
+        seen.append(controller.in_flight)
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        handler()
+    assert seen == [1]
+    assert controller.in_flight == 0
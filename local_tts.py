@@ -0,0 +1,50 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the ElevenLabs TTS API, for tests and benchmarks.
+
+Select it with `TTS_BACKEND=local`. It returns silent but valid mp3 audio whose
+length grows with the text, framed the way a real provider does it (ID3 tag,
+Info frame, then audio), after sleeping for a latency that also grows with the
+text.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+
+# Simulated provider latency: a fixed cost per request plus a cost per character
+LATENCY_BASE_MS = float(os.environ.get("LOCAL_TTS_LATENCY_BASE_MS", "250"))
+LATENCY_PER_CHAR_MS = float(os.environ.get("LOCAL_TTS_LATENCY_PER_CHAR_MS", "10"))
+
+# Roughly 15 characters are spoken per second
+SECONDS_PER_CHAR = 1 / 15
+
+# MPEG1 Layer III, 128kbps, 44.1kHz, mono. All-zero side info decodes as silence.
+_FRAME_HEADER = b"\xff\xfb\x90\xc0"
+_FRAME_LENGTH = 417
+_FRAME_SECONDS = 1152 / 44100
+SILENT_FRAME = _FRAME_HEADER + bytes(_FRAME_LENGTH - len(_FRAME_HEADER))
+# Same frame carrying an "Info" tag after the 17 bytes of mono side info
+INFO_FRAME = _FRAME_HEADER + bytes(17) + b"Info" + bytes(_FRAME_LENGTH - 25)
+# Empty ID3v2.4 tag
+ID3_TAG = b"ID3\x04\x00\x00\x00\x00\x00\x00"
+
+
+def generate(text: str, voice: str | None = None, model: str | None = None) -> bytes:
+    """Mirrors `elevenlabs.generate`, returning silent mp3 audio for `text`."""
+    time.sleep((LATENCY_BASE_MS + LATENCY_PER_CHAR_MS * len(text)) / 1000)
+    frames = max(1, round(len(text) * SECONDS_PER_CHAR / _FRAME_SECONDS))
+    return ID3_TAG + INFO_FRAME + SILENT_FRAME * frames
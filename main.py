@@ -12,17 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import datetime
+import io
 import signal
 import sys
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from types import FrameType
 
-from flask import Flask, render_template, request, Response
+from flask import Flask, g, request, Response
+from werkzeug.datastructures import FileStorage
 
+import assets
+import cache
 import database
+import load_control
 import middleware
-from middleware import jwt_authenticated, logger
+import pool_monitor
+import profiling
+import single_flight
+import speech
+import tracing
+from idempotency import idempotent, once
+from middleware import admin_required, jwt_authenticated, logger
 
 from parsing import (
     transcribe_from_audio,
@@ -38,6 +52,22 @@ app = Flask(__name__, static_folder="static", static_url_path="")
 
 app.config['MAX_CONTENT_PATH'] = 16 * 1024 * 1024 # 16mb should be heaps right?
 
+# Batch questions: most files per request, how many of a request's items are
+# answered at once, and how long to wait for the slowest before reporting it as
+# timed out. Items still running then stop before their next stage, and aren't
+# charged for. Each request gets its own threads, so one batch can't hold up
+# the items of another.
+BATCH_MAX_ITEMS = 20
+BATCH_MAX_WORKERS = 4
+BATCH_ITEM_TIMEOUT_SECONDS = 60
+
+# Most (uid, amount) pairs accepted by one bulk token request
+BULK_TOKENS_MAX_CHANGES = 100_000
+
+assets.init_app(app)
+profiling.init_app(app)
+tracing.init_app(app)
+
 
 @app.before_first_request
 def create_table() -> None:
@@ -47,27 +77,43 @@ def create_table() -> None:
     check_auth_keys()
 
 
-@app.route("/", methods=["GET"])
-def index() -> str:
-    """Renders default UI with votes from database."""
-    context = database.get_index_context()
+@app.before_request
+def start_query_stats() -> None:
+    """Count the database queries made while handling this request."""
+    database.begin_query_stats()
 
-    welcome_message = "Ask Mr. Know-It-All anything you'd like!"
 
-    context["welcome_message"] = welcome_message
-    return render_template("index.html", **context)
+@app.after_request
+def log_query_stats(response: Response) -> Response:
+    stats = database.end_query_stats()
+    if stats is not None and stats.count:
+        logger.info("request query stats", path=request.path, **stats.as_dict())
+    return response
+
+
+@app.route("/", methods=["GET"])
+def index() -> Response:
+    """Renders default UI."""
+    # The page shows nothing from the database, so it only changes with a deploy
+    return assets.render_cached("index.html")
 
 @app.route("/faq/", methods=["GET"])
-def faq_page() -> str:
-    return render_template("faq.html")
+def faq_page() -> Response:
+    return assets.render_cached("faq.html")
+
+def debit_question(token_cost: int) -> int:
+    """Debits a question, once even if the request is retried after failing later."""
+    return once("debit", lambda: database.add_tokens_to_user(request.uid, -1 * token_cost))
 
 @app.route("/ask/", methods=["POST"])
 @jwt_authenticated
+@load_control.tracked
+@idempotent
 def ask_question() -> Response:
     audio_file = request.files['audio_file']
 
     user_tokens = database.get_tokens_for_uid(request.uid)
-    if user_tokens <= 0:
+    if user_tokens is not None and user_tokens <= 0:
         # return Response(status=500,
         #     response="Not enough tokens to ask a question!"
         # )
@@ -85,31 +131,69 @@ def ask_question() -> Response:
 
     transcript = transcribe_from_audio(audio_file)
 
-    answer = answer_my_question(transcript, user_context)
+    # Answer more briefly, with less context and faster TTS while overloaded
+    degradation = load_control.controller.degradation()
+    load_control.log_degradation(degradation, clean_response_len)
+    response_length = min(clean_response_len, degradation.max_response_length)
+
+    answer = answer_my_question(transcript, user_context, response_length, degradation.context_messages)
 
     token_cost = calculate_query_cost(answer)
 
     logger.info(f"{request.uid} - {token_cost}")
 
+    sanitised_answer = sanitise_text(answer)
+
+    if request.form.get('audio_mode') == 'deferred':
+        # Return the text now and synthesize the audio when it's first fetched
+        audio_id = speech.defer(
+            answer,
+            prefetch=request.form.get('prefetch_audio') == '1',
+            model=degradation.tts_model,
+        )
+        try:
+            new_tokens = debit_question(token_cost)
+        except Exception as e:
+            logger.error(f"User not found error")
+            logger.exception(e)
+            return Response(status=500,
+                response="Something went wrong! User not found!"
+            )
+        return Response(
+            response=json.dumps({
+                "filename": audio_file.filename,
+                "transcription": transcript,
+                "cost": token_cost,
+                "tokens": new_tokens,
+                "answer": sanitised_answer,
+                "audio_url": f"/answers/{audio_id}/audio/",
+            }),
+            status=200,
+            content_type="application/json",
+        )
+
     try:
-        new_tokens = database.add_tokens_to_user(request.uid, -1 * token_cost)
+        answer_audio = text_to_speech(answer, degradation.tts_model)
     except Exception as e:
-        logger.error(f"User not found error")
+        logger.error("Failed to perform Text-to-speech conversion")
         logger.exception(e)
         return Response(status=500,
-            response="Something went wrong! User not found!"
+            response="Unable to perform text to speech"
         )
 
+    # Only charged once there's an answer to give
     try:
-        answer_audio = text_to_speech(answer)
+        new_tokens = debit_question(token_cost)
     except Exception as e:
-        logger.error("Failed to perform Text-to-speech conversion")
+        logger.error(f"User not found error")
         logger.exception(e)
         return Response(status=500,
-            response="Unable to perform text to speech"
+            response="Something went wrong! User not found!"
         )
-    
-    sanitised_answer = sanitise_text(answer)
+
+    # Retries with the same Idempotency-Key re-read the audio from the speech cache
+    g.idempotent_audio_text = answer
+    g.idempotent_audio_model = degradation.tts_model
 
     response_header = {
         "Content-Disposition": f"attachment; filename={audio_file.filename}",
@@ -128,6 +212,175 @@ def ask_question() -> Response:
         headers=response_header
     )
 
+@app.route("/answers/<audio_id>/audio/", methods=["GET"])
+def deferred_answer_audio(audio_id: str) -> Response:
+    """Serves the audio for an answer returned with `audio_mode=deferred`.
+
+    The id is unguessable and only given to the asking user, so this doesn't need
+    an Authorization header and can be used directly as an <audio> source.
+    """
+    try:
+        answer_audio = speech.synthesize(audio_id)
+    except Exception as e:
+        logger.error("Failed to perform Text-to-speech conversion")
+        logger.exception(e)
+        return Response(status=500,
+            response="Unable to perform text to speech"
+        )
+    if answer_audio is None:
+        return Response(status=404, response="Unknown or expired answer")
+
+    return Response(
+        response=answer_audio,
+        status=200,
+        content_type="audio/mp3",
+        headers={"Cache-Control": "private, max-age=3600", "file_size": str(len(answer_audio))},
+    )
+
+def check_batch_deadline(deadline: float, stage: str) -> None:
+    if time.monotonic() >= deadline:
+        raise TimeoutError(f"Batch deadline passed before {stage}")
+
+def answer_batch_item(
+    audio_file: FileStorage,
+    user_context: list,
+    response_length: int,
+    degradation: load_control.Degradation,
+    deadline: float,
+) -> dict:
+    """Runs the transcription, answer and TTS stages for one batch item.
+
+    Raises:
+        TimeoutError: if `deadline` (a `time.monotonic` time) passes before a stage.
+    """
+    check_batch_deadline(deadline, "transcription")
+    transcript = transcribe_from_audio(audio_file)
+    check_batch_deadline(deadline, "answering")
+    answer = answer_my_question(
+        transcript,
+        user_context,
+        min(response_length, degradation.max_response_length),
+        degradation.context_messages,
+    )
+    check_batch_deadline(deadline, "text to speech")
+    answer_audio = text_to_speech(answer, degradation.tts_model)
+    return {
+        "filename": audio_file.filename,
+        "transcription": transcript,
+        "answer": sanitise_text(answer),
+        "cost": calculate_query_cost(answer),
+        "audio": base64.b64encode(answer_audio).decode("ascii"),
+    }
+
+@app.route("/ask/batch/", methods=["POST"])
+@jwt_authenticated
+@load_control.tracked
+def ask_question_batch() -> Response:
+    """Answers several recorded questions in one request.
+
+    Expects `audio_files` (repeated), plus optional JSON lists `chat_contexts` and
+    `response_lengths` matching them by position. Items run concurrently and the
+    whole batch is debited in a single update. Returns JSON with a result or an
+    error per item.
+    """
+    audio_files = request.files.getlist('audio_files')
+    if not audio_files or len(audio_files) > BATCH_MAX_ITEMS:
+        return Response(status=400,
+            response=f"Send between 1 and {BATCH_MAX_ITEMS} audio files"
+        )
+
+    try:
+        user_contexts = json.loads(request.form.get('chat_contexts', '[]'))
+        response_lengths = json.loads(request.form.get('response_lengths', '[]'))
+    except ValueError:
+        return Response(status=400, response="Badly formed chat_contexts or response_lengths")
+
+    user_tokens = database.get_tokens_for_uid(request.uid)
+    if user_tokens is not None and user_tokens <= 0:
+        logger.warning(f"user {request.uid} has a negative token balance {user_tokens}")
+
+    degradation = load_control.controller.degradation()
+    deadline = time.monotonic() + BATCH_ITEM_TIMEOUT_SECONDS
+    batch_executor = ThreadPoolExecutor(
+        max_workers=min(BATCH_MAX_WORKERS, len(audio_files)), thread_name_prefix="batch"
+    )
+    futures = []
+    for index, audio_file in enumerate(audio_files):
+        user_context = user_contexts[index] if index < len(user_contexts) else []
+        try:
+            response_length = validate_response_length(int(response_lengths[index]))
+        except (IndexError, TypeError, ValueError):
+            response_length = 20
+        load_control.log_degradation(degradation, response_length)
+        # Upload streams are closed when the request ends, items may still be running
+        upload = FileStorage(
+            stream=io.BytesIO(audio_file.read()),
+            filename=audio_file.filename,
+            content_type=audio_file.content_type,
+        )
+        futures.append(
+            batch_executor.submit(
+                answer_batch_item, upload, user_context, response_length, degradation, deadline
+            )
+        )
+
+    # Report whatever hasn't finished in time rather than holding up the rest
+    wait(futures, timeout=max(0, deadline - time.monotonic()))
+    # Items that haven't started never will, running ones stop at their next stage
+    batch_executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for future in futures:
+        if future.cancelled() or not future.done():
+            results.append({"error": "Timed out"})
+            continue
+        try:
+            results.append(future.result())
+        except TimeoutError:
+            results.append({"error": "Timed out"})
+        except Exception as e:
+            logger.error("Failed to answer batch item")
+            logger.exception(e)
+            results.append({"error": "Unable to answer question"})
+
+    total_cost = sum(result.get("cost", 0) for result in results)
+    logger.info(f"{request.uid} - {total_cost} for a batch of {len(results)}")
+
+    try:
+        new_tokens = database.add_tokens_to_user(request.uid, -1 * total_cost)
+    except Exception as e:
+        logger.error(f"User not found error")
+        logger.exception(e)
+        return Response(status=500,
+            response="Something went wrong! User not found!"
+        )
+
+    return Response(
+        response=json.dumps({"cost": total_cost, "tokens": new_tokens, "results": results}),
+        status=200,
+        content_type="application/json",
+    )
+
+# Fields accepted from the browser, anything else is dropped
+CLIENT_METRIC_FIELDS = {"time_to_first_audio_ms": int, "playback_mode": str}
+
+
+@app.route("/client_metrics/", methods=["POST"])
+def client_metrics() -> Response:
+    """Logs timings measured in the browser, e.g. time to first answer audio."""
+    payload = request.get_json(force=True, silent=True)
+    if not isinstance(payload, dict):
+        return Response(status=400)
+
+    metrics = {}
+    for field, field_type in CLIENT_METRIC_FIELDS.items():
+        value = payload.get(field)
+        if isinstance(value, field_type) and not isinstance(value, bool):
+            metrics[field] = value if field_type is not str else value[:16]
+    if metrics:
+        logger.info("client metrics", **metrics)
+    return Response(status=204)
+
 @app.route("/initialise_user/", methods=["GET"])
 @jwt_authenticated
 def init_user() -> Response:
@@ -144,9 +397,10 @@ def init_user() -> Response:
 @jwt_authenticated
 def get_token_count() -> Response:
     uid = request.uid
-    database.initialise_user_if_required(request.uid)
+    created = database.initialise_user_if_required(request.uid)
     try:
-        token_count = database.get_tokens_for_uid(uid)
+        # A user created just now may not have reached the replicas yet
+        token_count = database.get_tokens_for_uid(uid, allow_stale=not created)
     except Exception as e:
         logger.exception(e)
         return Response(
@@ -160,6 +414,7 @@ def get_token_count() -> Response:
 
 @app.route("/tokens/", methods=["PUT"])
 @jwt_authenticated
+@idempotent
 def add_tokens() -> Response:
     uid = request.uid
     database.initialise_user_if_required(request.uid)
@@ -177,6 +432,81 @@ def add_tokens() -> Response:
         response=str(new_token_count),
     )
 
+@app.route("/admin/tokens/bulk/", methods=["POST"])
+@jwt_authenticated
+@admin_required
+@idempotent
+def bulk_tokens() -> Response:
+    """Changes the token balances of many users at once.
+
+    Expects JSON with `mode` ("delta" or "absolute") and either `changes`, a list
+    of {"uid": ..., "amount": ...}, or an `amount` applied to every user matching
+    `where` (see `database.token_predicate`). Returns a summary of the update.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return Response(status=400, response="Expected a JSON object")
+    mode = body.get("mode", "delta")
+
+    try:
+        if "changes" in body:
+            changes = body["changes"]
+            if not isinstance(changes, list) or len(changes) > BULK_TOKENS_MAX_CHANGES:
+                return Response(status=400,
+                    response=f"Send a list of up to {BULK_TOKENS_MAX_CHANGES} changes"
+                )
+            pairs = [(str(change["uid"]), int(change["amount"])) for change in changes]
+            summary = database.bulk_update_tokens(pairs, mode)
+        elif "where" in body and "amount" in body:
+            if not isinstance(body["where"], dict):
+                return Response(status=400, response="`where` must be an object")
+            summary = database.bulk_update_tokens_where(body["where"], int(body["amount"]), mode)
+        else:
+            return Response(status=400, response="Send either `changes` or `where` and `amount`")
+    except (KeyError, TypeError, ValueError) as e:
+        return Response(status=400, response=f"Badly formed bulk token request: {e}")
+    except database.BulkTokenError as e:
+        logger.exception(e)
+        return Response(
+            status=500,
+            response=json.dumps({"error": "Bulk token update failed", **e.summary._asdict()}),
+            content_type="application/json",
+        )
+
+    return Response(
+        status=200,
+        response=json.dumps(summary._asdict()),
+        content_type="application/json",
+    )
+
+@app.route("/admin/metrics/", methods=["GET"])
+@jwt_authenticated
+@admin_required
+def metrics() -> Response:
+    """Connection pool, cache and call coalescing metrics for this worker."""
+    return Response(
+        status=200,
+        response=json.dumps({
+            "pools": pool_monitor.pool_metrics(),
+            "caches": cache.all_stats(),
+            "single_flight": single_flight.all_stats(),
+        }),
+        content_type="application/json",
+    )
+
+@app.route("/admin/profile/", methods=["GET"])
+@jwt_authenticated
+@admin_required
+def download_profile() -> Response:
+    """Downloads the sampled profiles of every worker as collapsed stacks."""
+    profiling.profiler.flush()
+    return Response(
+        status=200,
+        response=profiling.merged_profile(profiling.profiler.profile_dir),
+        content_type="text/plain",
+        headers={"Content-Disposition": "attachment; filename=profile.folded"},
+    )
+
 
 # https://cloud.google.com/blog/topics/developers-practitioners/graceful-shutdowns-cloud-run-deep-dive
 # [START cloudrun_sigterm_handler]
@@ -15,6 +15,9 @@
 
 from __future__ import annotations
 
+import hashlib
+import os
+import time
 from collections.abc import Callable
 from functools import wraps
 from typing import TypeVar
@@ -24,12 +27,52 @@ from firebase_admin import auth  # noqa: F401
 from flask import request, Response
 import structlog
 
+from cache import get_cache
+
 
 a = TypeVar("a")
 
 default_app = firebase_admin.initialize_app()
 
 
+def verify_token(token: str) -> dict:
+    """Verifies a Firebase ID token, reusing earlier verifications of the same token.
+
+    Raises:
+        Exception: if the token is invalid.
+    """
+    # Key on a digest so raw ID tokens never end up in a shared cache
+    auth_cache = get_cache("auth")
+    token_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    decoded_token = auth_cache.get(token_key)
+    if decoded_token is None or decoded_token["exp"] <= time.time():
+        decoded_token = firebase_admin.auth.verify_id_token(token)
+        # Never keep a verified token past its own expiry
+        auth_cache.set(
+            token_key,
+            {"uid": decoded_token["uid"], "exp": decoded_token["exp"]},
+            ttl=decoded_token["exp"] - time.time(),
+        )
+    return decoded_token
+
+
+def admin_uids() -> set[str]:
+    """The uids allowed to use admin endpoints, from the `ADMIN_UIDS` env var."""
+    return {uid.strip() for uid in os.environ.get("ADMIN_UIDS", "").split(",") if uid.strip()}
+
+
+def is_admin_request() -> bool:
+    """Whether the current request carries a valid ID token for an admin."""
+    header = request.headers.get("Authorization", None)
+    if not header or " " not in header:
+        return False
+    try:
+        decoded_token = verify_token(header.split(" ")[1])
+    except Exception:
+        return False
+    return decoded_token["uid"] in admin_uids()
+
+
 # [START cloudrun_user_auth_jwt]
 def jwt_authenticated(func: Callable[..., int]) -> Callable[..., int]:
     """Use the Firebase Admin SDK to parse Authorization header to verify the
@@ -44,7 +87,7 @@ def jwt_authenticated(func: Callable[..., int]) -> Callable[..., int]:
         if header:
             token = header.split(" ")[1]
             try:
-                decoded_token = firebase_admin.auth.verify_id_token(token)
+                decoded_token = verify_token(token)
             except Exception as e:
                 logger.exception(e)
                 return Response(status=403, response=f"Error with authentication: {e}")
@@ -59,6 +102,19 @@ def jwt_authenticated(func: Callable[..., int]) -> Callable[..., int]:
 
 # [END cloudrun_user_auth_jwt]
 
+
+def admin_required(func: Callable[..., int]) -> Callable[..., int]:
+    """Restricts a `jwt_authenticated` route to the uids listed in `ADMIN_UIDS`."""
+
+    @wraps(func)
+    def decorated_function(*args: a, **kwargs: a) -> a:
+        if request.uid not in admin_uids():
+            return Response(status=403, response="Admin access required")
+        return func(*args, **kwargs)
+
+    return decorated_function
+
+
 # adapted from https://github.com/ymotongpoo/cloud-logging-configurations/blob/master/python/structlog/main.py
 
 
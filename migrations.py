@@ -0,0 +1,431 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A minimal versioned schema migration runner.
+
+Each migration is applied in its own transaction and recorded in the
+`schema_migrations` table, unless it is marked non-transactional and commits
+its own steps. On PostgreSQL the whole run is serialised with an advisory lock
+so several instances starting at once don't race each other.
+
+Migrations are applied by running this module, `python migrations.py`, which
+the container does before starting the web server. Large data migrations can
+take a while, so on a big database run it as a one-off job before deploying.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import datetime
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import NamedTuple
+
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+
+from middleware import logger
+
+# Arbitrary application-wide key for pg_advisory_lock
+MIGRATION_LOCK_KEY = 725_146_001
+
+# How many months of pet_votes partitions to keep created ahead of time
+PARTITION_MONTHS_AHEAD = 3
+
+# Rows copied per transaction when partitioning pet_votes
+PARTITION_COPY_BATCH_SIZE = 50_000
+
+# How often running instances check the pet_votes partitions
+PARTITION_CHECK_INTERVAL_SECONDS = float(
+    os.environ.get("PARTITION_CHECK_INTERVAL", str(6 * 60 * 60))
+)
+
+schema_migrations = sqlalchemy.Table(
+    "schema_migrations",
+    sqlalchemy.MetaData(),
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True, autoincrement=False),
+    sqlalchemy.Column("name", sqlalchemy.String(128), nullable=False),
+    sqlalchemy.Column("applied_at", sqlalchemy.DateTime, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Connection], None]
+    # Non-transactional migrations commit their own steps and must be safe to resume
+    transactional: bool = True
+
+
+def _is_postgres(conn: Connection) -> bool:
+    return conn.dialect.name == "postgresql"
+
+
+def _is_partitioned(conn: Connection, table: str) -> bool:
+    return conn.execute(
+        sqlalchemy.text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+            "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table)"
+        ),
+        parameters={"table": table},
+    ).scalar()
+
+
+def _create_initial_tables(conn: Connection) -> None:
+    # Imported here to avoid a circular import, database runs the migrations
+    import database
+
+    database.metadata.create_all(
+        conn, tables=[database.pet_votes, database.active_users], checkfirst=True
+    )
+
+
+@contextlib.contextmanager
+def _autocommit(conn: Connection) -> Iterator[None]:
+    conn.execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        yield
+    finally:
+        conn.execution_options(isolation_level=conn.default_isolation_level)
+
+
+def _create_index(conn: Connection, name: str, definition: str) -> None:
+    """Creates an index, on PostgreSQL without blocking writes to the table.
+
+    Must be called outside a transaction, from a non-transactional migration.
+    """
+    if not _is_postgres(conn):
+        with conn.begin():
+            conn.execute(sqlalchemy.text(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}"))
+        return
+    with _autocommit(conn):
+        invalid = conn.execute(
+            sqlalchemy.text(
+                "SELECT NOT i.indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+            ),
+            parameters={"name": name},
+        ).scalar()
+        if invalid:
+            # Left behind by an interrupted CREATE INDEX CONCURRENTLY
+            conn.execute(sqlalchemy.text(f"DROP INDEX CONCURRENTLY {name}"))
+        conn.execute(
+            sqlalchemy.text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+        )
+
+
+def _index_pet_votes_time_cast(conn: Connection) -> None:
+    # Serves "ORDER BY time_cast DESC LIMIT 5" with a backwards index scan
+    _create_index(conn, "ix_pet_votes_time_cast", "pet_votes (time_cast)")
+
+
+def _index_pet_votes_candidate(conn: Connection) -> None:
+    # Lets the per-candidate COUNT run as an index-only scan
+    _create_index(conn, "ix_pet_votes_candidate", "pet_votes (candidate, vote_id)")
+
+
+def _month_start(value: datetime.datetime) -> datetime.date:
+    return datetime.date(value.year, value.month, 1)
+
+
+def _next_month(value: datetime.date) -> datetime.date:
+    if value.month == 12:
+        return datetime.date(value.year + 1, 1, 1)
+    return datetime.date(value.year, value.month + 1, 1)
+
+
+def _create_vote_partition(conn: Connection, month: datetime.date, parent: str = "pet_votes") -> None:
+    partition = f"{parent}_{month:%Y_%m}"
+    conn.execute(
+        sqlalchemy.text(
+            f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {parent} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+        )
+    )
+
+
+def _copy_votes(conn: Connection, after: int, up_to: int) -> None:
+    """Copies the votes with ids in (after, up_to] into the partitioned table."""
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO pet_votes_partitioned (vote_id, time_cast, candidate, uid) "
+            "SELECT vote_id, time_cast, candidate, uid FROM pet_votes "
+            "WHERE vote_id > :after AND vote_id <= :up_to"
+        ),
+        parameters={"after": after, "up_to": up_to},
+    )
+
+
+def _max_vote_id(conn: Connection, table: str) -> int:
+    return conn.execute(sqlalchemy.text(f"SELECT COALESCE(MAX(vote_id), 0) FROM {table}")).scalar()
+
+
+def _partition_pet_votes(conn: Connection) -> None:
+    """Turns pet_votes into a table range partitioned by month on time_cast.
+
+    The votes are copied into a new partitioned table in batches, each in its
+    own transaction, while the app keeps using pet_votes. The votes cast during
+    the copy are moved and the tables swapped in one short final transaction.
+    An interrupted run picks up the copy where it left off.
+    """
+    if not _is_postgres(conn):
+        logger.info("Skipping pet_votes partitioning, only supported on PostgreSQL")
+        return
+    with conn.begin():
+        if _is_partitioned(conn, "pet_votes"):
+            # A previous run swapped the tables but didn't get to record it
+            return
+
+    with conn.begin():
+        # Keep the existing id sequence so vote ids carry on from where they were
+        conn.execute(
+            sqlalchemy.text(
+                "CREATE TABLE IF NOT EXISTS pet_votes_partitioned"
+                "( vote_id INTEGER NOT NULL DEFAULT nextval('pet_votes_vote_id_seq'), "
+                "time_cast timestamp NOT NULL, "
+                "candidate VARCHAR(6) NOT NULL, "
+                "uid VARCHAR(128) NOT NULL, "
+                "CONSTRAINT pet_votes_partitioned_pkey PRIMARY KEY (vote_id, time_cast)"
+                ") PARTITION BY RANGE (time_cast);"
+            )
+        )
+        conn.execute(
+            sqlalchemy.text(
+                "CREATE TABLE IF NOT EXISTS pet_votes_partitioned_default "
+                "PARTITION OF pet_votes_partitioned DEFAULT"
+            )
+        )
+        oldest = conn.execute(sqlalchemy.text("SELECT MIN(time_cast) FROM pet_votes")).scalar()
+        month = _month_start(oldest or datetime.datetime.utcnow())
+        last = _month_start(datetime.datetime.utcnow())
+        for _ in range(PARTITION_MONTHS_AHEAD):
+            last = _next_month(last)
+        while month <= last:
+            _create_vote_partition(conn, month, parent="pet_votes_partitioned")
+            month = _next_month(month)
+        # Indexes on the parent are created on every partition, current and future.
+        # Built now, while empty, they are renamed to the usual names in the swap.
+        conn.execute(
+            sqlalchemy.text(
+                "CREATE INDEX IF NOT EXISTS ix_pet_votes_partitioned_time_cast "
+                "ON pet_votes_partitioned (time_cast)"
+            )
+        )
+        conn.execute(
+            sqlalchemy.text(
+                "CREATE INDEX IF NOT EXISTS ix_pet_votes_partitioned_candidate "
+                "ON pet_votes_partitioned (candidate, vote_id)"
+            )
+        )
+
+    with conn.begin():
+        copied = _max_vote_id(conn, "pet_votes_partitioned")
+        newest = _max_vote_id(conn, "pet_votes")
+    while copied < newest:
+        batch_end = min(copied + PARTITION_COPY_BATCH_SIZE, newest)
+        with conn.begin():
+            _copy_votes(conn, copied, batch_end)
+        copied = batch_end
+        logger.info(f"Copied pet_votes up to vote {copied} of {newest}")
+
+    with conn.begin():
+        # Holds back new votes, but not reads, while the last ones are copied
+        conn.execute(sqlalchemy.text("LOCK TABLE pet_votes IN EXCLUSIVE MODE"))
+        _copy_votes(conn, copied, _max_vote_id(conn, "pet_votes"))
+
+        partitions = conn.execute(
+            sqlalchemy.text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = 'pet_votes_partitioned'"
+            )
+        ).scalars().all()
+        conn.execute(sqlalchemy.text("ALTER SEQUENCE pet_votes_vote_id_seq OWNED BY NONE"))
+        conn.execute(sqlalchemy.text("DROP TABLE pet_votes"))
+        conn.execute(sqlalchemy.text("ALTER TABLE pet_votes_partitioned RENAME TO pet_votes"))
+        for partition in partitions:
+            renamed = partition.replace("pet_votes_partitioned", "pet_votes", 1)
+            conn.execute(sqlalchemy.text(f"ALTER TABLE {partition} RENAME TO {renamed}"))
+        conn.execute(
+            sqlalchemy.text(
+                "ALTER TABLE pet_votes "
+                "RENAME CONSTRAINT pet_votes_partitioned_pkey TO pet_votes_pkey"
+            )
+        )
+        for column in ("time_cast", "candidate"):
+            conn.execute(
+                sqlalchemy.text(
+                    f"ALTER INDEX ix_pet_votes_partitioned_{column} RENAME TO ix_pet_votes_{column}"
+                )
+            )
+        conn.execute(
+            sqlalchemy.text("ALTER SEQUENCE pet_votes_vote_id_seq OWNED BY pet_votes.vote_id")
+        )
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "create initial tables", _create_initial_tables),
+    Migration(2, "index pet_votes time_cast", _index_pet_votes_time_cast, transactional=False),
+    Migration(3, "index pet_votes candidate", _index_pet_votes_candidate, transactional=False),
+    Migration(4, "partition pet_votes by month", _partition_pet_votes, transactional=False),
+]
+
+
+def ensure_vote_partitions(conn: Connection) -> None:
+    """Creates the pet_votes partitions for the coming months if they are missing.
+
+    Logs an error if any votes have landed in the default partition, which
+    happens when the partitions ran out before this was next called.
+    """
+    if not _is_postgres(conn) or not _is_partitioned(conn, "pet_votes"):
+        return
+
+    month = _month_start(datetime.datetime.utcnow())
+    for _ in range(PARTITION_MONTHS_AHEAD + 1):
+        try:
+            with conn.begin_nested():
+                _create_vote_partition(conn, month)
+        except sqlalchemy.exc.DBAPIError as e:
+            # Rows for this month already landed in the default partition
+            logger.error(f"Unable to create pet_votes partition for {month}: {e}")
+        month = _next_month(month)
+
+    misplaced = conn.execute(
+        sqlalchemy.text("SELECT MIN(time_cast), COUNT(*) FROM pet_votes_default")
+    ).one()
+    if misplaced[1]:
+        logger.error(
+            f"{misplaced[1]} pet_votes rows since {misplaced[0]} are in the default "
+            "partition. Detach it, create the missing monthly partitions, move the "
+            "rows into pet_votes and reattach it."
+        )
+
+
+def _check_vote_partitions(engine: Engine) -> None:
+    with engine.connect() as conn:
+        with conn.begin():
+            # Another instance, or a migration run, may be at it already
+            locked = conn.execute(
+                sqlalchemy.text("SELECT pg_try_advisory_xact_lock(:key)"),
+                parameters={"key": MIGRATION_LOCK_KEY},
+            ).scalar()
+            if locked:
+                ensure_vote_partitions(conn)
+
+
+def _check_vote_partitions_periodically(engine: Engine) -> None:
+    while True:
+        time.sleep(PARTITION_CHECK_INTERVAL_SECONDS)
+        try:
+            _check_vote_partitions(engine)
+        except Exception as e:
+            logger.warning(f"Unable to check pet_votes partitions: {e}")
+
+
+_partition_checker: threading.Thread | None = None
+_partition_checker_lock = threading.Lock()
+
+
+def maintain_vote_partitions(engine: Engine) -> None:
+    """Keeps creating pet_votes partitions ahead of time while the app runs."""
+    global _partition_checker
+    if engine.dialect.name != "postgresql":
+        return
+    with _partition_checker_lock:
+        if _partition_checker is None:
+            _partition_checker = threading.Thread(
+                target=_check_vote_partitions_periodically,
+                args=(engine,),
+                name="vote-partitions",
+                daemon=True,
+            )
+            _partition_checker.start()
+
+
+def applied_versions(conn: Connection) -> set[int]:
+    schema_migrations.create(conn, checkfirst=True)
+    return set(conn.execute(sqlalchemy.select(schema_migrations.c.version)).scalars())
+
+
+def pending_versions(engine: Engine, migrations: list[Migration] = MIGRATIONS) -> list[int]:
+    """The versions of the migrations that haven't been applied yet."""
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+    return sorted(m.version for m in migrations if m.version not in done)
+
+
+def run_migrations(engine: Engine, migrations: list[Migration] = MIGRATIONS) -> list[int]:
+    """Applies any pending migrations in version order.
+
+    Args:
+        engine: the engine to migrate
+        migrations: the migrations to consider, defaults to MIGRATIONS
+
+    Returns:
+        The versions that were applied by this call.
+    """
+    applied = []
+    with engine.connect() as conn:
+        if _is_postgres(conn):
+            conn.execute(
+                sqlalchemy.text("SELECT pg_advisory_lock(:key)"),
+                parameters={"key": MIGRATION_LOCK_KEY},
+            )
+            conn.commit()
+        try:
+            with conn.begin():
+                done = applied_versions(conn)
+
+            for migration in sorted(migrations, key=lambda m: m.version):
+                if migration.version in done:
+                    continue
+                logger.info(f"Applying migration {migration.version}: {migration.name}")
+                if not migration.transactional:
+                    migration.apply(conn)
+                with conn.begin():
+                    if migration.transactional:
+                        migration.apply(conn)
+                    conn.execute(
+                        schema_migrations.insert(),
+                        parameters={
+                            "version": migration.version,
+                            "name": migration.name,
+                            "applied_at": datetime.datetime.utcnow(),
+                        },
+                    )
+                applied.append(migration.version)
+
+            with conn.begin():
+                ensure_vote_partitions(conn)
+        finally:
+            if _is_postgres(conn):
+                conn.rollback()
+                conn.execute(
+                    sqlalchemy.text("SELECT pg_advisory_unlock(:key)"),
+                    parameters={"key": MIGRATION_LOCK_KEY},
+                )
+                conn.commit()
+
+    if applied:
+        logger.info(f"Applied migrations {applied}")
+    return applied
+
+
+if __name__ == "__main__":
+    import database
+
+    run_migrations(database.init_connection_engine())
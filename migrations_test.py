@@ -0,0 +1,91 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pathlib
+
+import pytest
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+
+import migrations
+from migrations import MIGRATIONS, Migration
+
+
+@pytest.fixture
+def engine(tmp_path: pathlib.Path) -> Engine:
+    return sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+
+
+def recorded(engine: Engine) -> list[int]:
+    with engine.connect() as conn:
+        return list(
+            conn.execute(sqlalchemy.select(migrations.schema_migrations.c.version)).scalars()
+        )
+
+
+def test_run_records_every_version(engine: Engine) -> None:
+    assert migrations.pending_versions(engine) == [m.version for m in MIGRATIONS]
+    assert migrations.run_migrations(engine) == [m.version for m in MIGRATIONS]
+
+    assert recorded(engine) == [m.version for m in MIGRATIONS]
+    assert migrations.pending_versions(engine) == []
+    indexes = {index["name"] for index in sqlalchemy.inspect(engine).get_indexes("pet_votes")}
+    assert {"ix_pet_votes_time_cast", "ix_pet_votes_candidate"} <= indexes
+
+
+def test_second_run_is_a_no_op(engine: Engine) -> None:
+    migrations.run_migrations(engine)
+    assert migrations.run_migrations(engine) == []
+    assert recorded(engine) == [m.version for m in MIGRATIONS]
+
+
+def test_only_new_migrations_run(engine: Engine) -> None:
+    migrations.run_migrations(engine, MIGRATIONS[:2])
+    assert migrations.pending_versions(engine) == [m.version for m in MIGRATIONS[2:]]
+    assert migrations.run_migrations(engine) == [m.version for m in MIGRATIONS[2:]]
+
+
+def add_user(conn: Connection) -> None:
+    conn.execute(
+        sqlalchemy.text("INSERT INTO active_users (username, tokens) VALUES ('seed', 100)")
+    )
+
+
+def fail(conn: Connection) -> None:
+    add_user(conn)
+    raise RuntimeError("migration failed")
+
+
+def users(engine: Engine) -> list[str]:
+    with engine.connect() as conn:
+        return list(conn.execute(sqlalchemy.text("SELECT username FROM active_users")).scalars())
+
+
+def test_failed_migration_is_rolled_back_and_not_recorded(engine: Engine) -> None:
+    with pytest.raises(RuntimeError):
+        migrations.run_migrations(engine, MIGRATIONS + [Migration(99, "seed user", fail)])
+
+    assert migrations.pending_versions(engine, MIGRATIONS + [Migration(99, "", fail)]) == [99]
+    assert users(engine) == []
+    # Fixed, it applies on the next run
+    fixed = MIGRATIONS + [Migration(99, "seed user", add_user)]
+    assert migrations.run_migrations(engine, fixed) == [99]
+    assert users(engine) == ["seed"]
+
+
+def test_partitioning_is_skipped_on_sqlite(engine: Engine) -> None:
+    migrations.run_migrations(engine)
+    with engine.connect() as conn:
+        migrations.ensure_vote_partitions(conn)
+    assert "pet_votes_default" not in sqlalchemy.inspect(engine).get_table_names()
@@ -0,0 +1,171 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Joins MPEG audio streams at frame boundaries without re-encoding.
+
+Each input has its ID3 tags and Xing/Info/VBRI header frame removed, since
+their sizes and durations would describe only that one piece, and the
+remaining audio frames are concatenated into a single stream. MPEG audio
+wrapped in a RIFF/WAVE file is read from its data chunk.
+"""
+
+from __future__ import annotations
+
+import struct
+from collections.abc import Iterable, Iterator
+
+# Bitrates in kbps indexed by [(version is MPEG1, layer)][bitrate index]
+_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+# Sample rates indexed by [version bits][sample rate index]
+_SAMPLE_RATES = {
+    0b11: (44100, 48000, 32000),  # MPEG1
+    0b10: (22050, 24000, 16000),  # MPEG2
+    0b00: (11025, 12000, 8000),  # MPEG2.5
+}
+
+_LAYERS = {0b11: 1, 0b10: 2, 0b01: 3}
+
+
+class Mp3Error(ValueError):
+    """Raised when data isn't a parseable MPEG audio stream."""
+
+
+def _frame_length(header: bytes) -> int | None:
+    """Returns the length of the frame starting with `header`, or None if it isn't one."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (header[1] >> 3) & 0b11
+    layer = _LAYERS.get((header[1] >> 1) & 0b11)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0b11
+    padding = (header[2] >> 1) & 1
+    if version_bits not in _SAMPLE_RATES or layer is None:
+        return None
+    if bitrate_index in (0, 15) or sample_rate_index == 3:
+        # Free format and reserved values aren't produced by any TTS provider
+        return None
+
+    is_mpeg1 = version_bits == 0b11
+    bitrate = _BITRATES[(is_mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version_bits][sample_rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 3 and not is_mpeg1:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+
+def _is_info_frame(frame: bytes) -> bool:
+    """Whether `frame` is a Xing/Info/VBRI header rather than audio."""
+    is_mpeg1 = (frame[1] >> 3) & 0b11 == 0b11
+    is_mono = frame[3] >> 6 == 0b11
+    if is_mpeg1:
+        side_info = 17 if is_mono else 32
+    else:
+        side_info = 9 if is_mono else 17
+    tag = frame[4 + side_info:8 + side_info]
+    return tag in (b"Xing", b"Info") or frame[36:40] == b"VBRI"
+
+
+def _skip_id3v2(data: bytes) -> int:
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    # The tag size is a 28 bit "syncsafe" integer, 7 bits per byte
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _riff_data(data: bytes) -> tuple[int, int] | None:
+    """Returns the bounds of the data chunk of a RIFF/WAVE file, or None if it isn't one."""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        (size,) = struct.unpack("<I", data[offset + 4:offset + 8])
+        if chunk_id == b"data":
+            return offset + 8, min(offset + 8 + size, len(data))
+        # Chunks are padded to an even length
+        offset += 8 + size + (size & 1)
+    raise Mp3Error("RIFF file has no data chunk")
+
+
+def iter_frames(data: bytes) -> Iterator[bytes]:
+    """Yields the audio frames of an MPEG audio stream, skipping tags and info frames.
+
+    Raises:
+        Mp3Error: if no frames are found.
+    """
+    riff_data = _riff_data(data)
+    if riff_data is not None:
+        data = data[riff_data[0]:riff_data[1]]
+
+    end = len(data)
+    if end >= 128 and data[-128:-125] == b"TAG":
+        end -= 128
+
+    offset = _skip_id3v2(data)
+    found = False
+    while offset + 4 <= end:
+        length = _frame_length(data[offset:offset + 4])
+        if length is None or offset + length > end:
+            # Resynchronise on the next frame header
+            offset += 1
+            continue
+        frame = data[offset:offset + length]
+        offset += length
+        found = True
+        if not _is_info_frame(frame):
+            yield frame
+
+    if not found:
+        raise Mp3Error("No MPEG audio frames found")
+
+
+def _samples_per_frame(header: bytes) -> int:
+    layer = _LAYERS[(header[1] >> 1) & 0b11]
+    if layer == 1:
+        return 384
+    if layer == 3 and (header[1] >> 3) & 0b11 != 0b11:
+        return 576
+    return 1152
+
+
+def duration(data: bytes) -> float:
+    """Returns the playing time of an MPEG audio stream in seconds.
+
+    Raises:
+        Mp3Error: if no frames are found.
+    """
+    seconds = 0.0
+    for frame in iter_frames(data):
+        sample_rate = _SAMPLE_RATES[(frame[1] >> 3) & 0b11][(frame[2] >> 2) & 0b11]
+        seconds += _samples_per_frame(frame) / sample_rate
+    return seconds
+
+
+def concat(streams: Iterable[bytes]) -> bytes:
+    """Joins MPEG audio streams frame by frame into one stream."""
+    return b"".join(frame for stream in streams for frame in iter_frames(stream))
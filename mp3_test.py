@@ -0,0 +1,85 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+import pytest
+
+from local_tts import ID3_TAG, INFO_FRAME, SILENT_FRAME
+import mp3
+
+
+def frame(marker: int) -> bytes:
+    """A silent frame told apart from the others by its last byte."""
+    return SILENT_FRAME[:-1] + bytes([marker])
+
+
+def id3v2(payload: bytes) -> bytes:
+    size = len(payload)
+    syncsafe = bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b"ID3\x04\x00\x00" + syncsafe + payload
+
+
+def riff(audio: bytes) -> bytes:
+    # WAVE_FORMAT_MPEGLAYER3, mono, 44.1kHz, 16000 bytes a second
+    fmt = struct.pack("<HHIIHHH", 0x55, 1, 44100, 16000, 1, 0, 0)
+    fact = struct.pack("<I", 44100)
+    # An odd sized chunk, padded to an even length
+    junk = b"\xff\xfb\x90"
+    trailer = b"INFOISFT" + struct.pack("<I", 4) + b"test"
+    chunks = [
+        (b"fmt ", fmt), (b"fact", fact), (b"junk", junk), (b"data", audio), (b"LIST", trailer)
+    ]
+    body = b"WAVE" + b"".join(
+        chunk_id + struct.pack("<I", len(chunk)) + chunk + b"\0" * (len(chunk) & 1)
+        for chunk_id, chunk in chunks
+    )
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+AUDIO = [frame(1), frame(2), frame(3)]
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"".join(AUDIO),
+        ID3_TAG + INFO_FRAME + b"".join(AUDIO),
+        id3v2(b"TIT2" + bytes(300)) + b"".join(AUDIO),
+        b"".join(AUDIO) + b"TAG" + bytes(125),
+        riff(b"".join(AUDIO)),
+        riff(ID3_TAG + INFO_FRAME + b"".join(AUDIO)),
+    ],
+    ids=["bare", "id3-info", "id3-padding", "id3v1", "riff", "riff-id3-info"],
+)
+def test_iter_frames_yields_only_audio(data: bytes) -> None:
+    assert list(mp3.iter_frames(data)) == AUDIO
+
+
+def test_concat_drops_every_header() -> None:
+    first = ID3_TAG + INFO_FRAME + frame(1) + frame(2)
+    second = riff(ID3_TAG + INFO_FRAME + frame(3))
+    joined = mp3.concat([first, second])
+    assert joined == b"".join(AUDIO)
+    assert mp3.duration(joined) == pytest.approx(3 * 1152 / 44100)
+
+
+def test_iter_frames_resynchronises_after_garbage() -> None:
+    assert list(mp3.iter_frames(b"\x00\xff\x01" + b"".join(AUDIO))) == AUDIO
+
+
+@pytest.mark.parametrize("data", [b"", b"not audio" * 100, riff(b"")])
+def test_no_frames(data: bytes) -> None:
+    with pytest.raises(mp3.Mp3Error):
+        list(mp3.iter_frames(data))
@@ -1,8 +1,18 @@
 
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
 import openai
 from elevenlabs import set_api_key, generate
 
+import load_control
+import local_tts
+import mp3
+from cache import cached, get_cache
 from middleware import logger
+from single_flight import single_flight
 
 from credentials import get_cred_config
 
@@ -22,16 +32,56 @@ def check_auth_keys():
 def validate_response_length(response_length_value: int):
     return max(min(200, response_length_value), 5)
 
+# Extensions Whisper decodes, by the MIME type an upload is labelled with
+WHISPER_EXTENSIONS = {
+    "audio/webm": "webm",
+    "video/webm": "webm",
+    "audio/ogg": "ogg",
+    "audio/mp4": "m4a",
+    "audio/x-m4a": "m4a",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/flac": "flac",
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+}
+WHISPER_SUFFIXES = set(WHISPER_EXTENSIONS.values()) | {"mp4", "mpeg", "mpga", "oga"}
+
+def whisper_filename(audio_file) -> str:
+    """Names an upload so Whisper decodes it as the container it really is.
+
+    Whisper picks the decoder from the file extension. Uploads that are already
+    named with a supported one keep it, otherwise it comes from the upload's MIME
+    type, defaulting to mp3 for older clients that label every recording as mp3.
+    """
+    filename = audio_file.filename or "audio"
+    stem, _, suffix = filename.rpartition(".")
+    if stem and suffix.lower() in WHISPER_SUFFIXES:
+        return filename
+    return f"{filename}.{WHISPER_EXTENSIONS.get(audio_file.mimetype, 'mp3')}"
+
 def transcribe_from_audio(audio_file):
 
     contents = audio_file.read()
-    transcript = openai.Audio.transcribe_raw("whisper-1", contents, f"{audio_file.filename}.mp3")
+
+    # Retried uploads of the same recording don't need transcribing again
+    transcripts = get_cache("transcripts")
+    audio_key = hashlib.sha256(contents).hexdigest()
+    body_text = transcripts.get(audio_key)
+    if body_text is not None:
+        return body_text
+
+    with load_control.timed("transcribe"):
+        transcript = openai.Audio.transcribe_raw("whisper-1", contents, whisper_filename(audio_file))
 
     body_text = transcript.get('text', '')
+    transcripts.set(audio_key, body_text)
 
     return body_text
 
-def answer_my_question(question_text, existing_context = [], requested_response_length = 20):
+@cached("answers")
+@single_flight("answers")
+def answer_my_question(question_text, existing_context = [], requested_response_length = 20, context_messages = 10):
 
     base_messages = [
         {"role": "system", "content": "Your name is Mr. Know-it-all. You are a polite and helpful teacher."},
@@ -40,7 +90,9 @@ def answer_my_question(question_text, existing_context = [], requested_response_
     ]
 
     is_user_message = True
-    for chat_item in existing_context[-10:]: # only use the 10 most recent messages as part of the context
+    # only use the most recent messages as part of the context
+    recent_context = existing_context[-context_messages:] if context_messages else []
+    for chat_item in recent_context:
         new_message = {
             "role": "user" if is_user_message else "assistant",
             "content": chat_item or ''
@@ -52,10 +104,11 @@ def answer_my_question(question_text, existing_context = [], requested_response_
 
     base_messages.append({"role": "user", "content": question_text})
 
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=base_messages
-    )
+    with load_control.timed("chat"):
+        response = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            messages=base_messages
+        )
 
     output_message = response.get('choices')[0].get('message').get('content')
 
@@ -67,7 +120,50 @@ def sanitise_text(text: str) -> str:
 
     return output
 
-def text_to_speech(text):
-
-    audio = generate(text, voice='Sam')
+TTS_VOICE = 'Sam'
+
+# Long answers are split into chunks of at least this many characters, made of
+# whole sentences, and synthesized concurrently on a pool of this size
+TTS_MIN_CHUNK_CHARS = 120
+TTS_MAX_WORKERS = 4
+
+_tts_executor = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix="tts")
+
+_sentence_end = re.compile(r'(?<=[.!?])\s+')
+
+def split_into_chunks(text: str, min_chars: int = TTS_MIN_CHUNK_CHARS) -> list[str]:
+    """Groups the sentences of `text` into chunks of at least `min_chars`."""
+    chunks = []
+    current = ''
+    for sentence in _sentence_end.split(text.strip()):
+        current = f"{current} {sentence}" if current else sentence
+        if len(current) >= min_chars:
+            chunks.append(current)
+            current = ''
+    if current:
+        if chunks and len(current) < min_chars // 2:
+            # Don't leave a short tail synthesized on its own
+            chunks[-1] = f"{chunks[-1]} {current}"
+        else:
+            chunks.append(current)
+    return chunks
+
+def synthesize_chunk(text, model=None):
+    # Only override the provider's default model when asked to
+    options = {"voice": TTS_VOICE} if model is None else {"voice": TTS_VOICE, "model": model}
+    with load_control.timed("tts"):
+        if os.environ.get("TTS_BACKEND") == "local":
+            return local_tts.generate(text, **options)
+        return generate(text, **options)
+
+@cached("speech")
+@single_flight("speech")
+def text_to_speech(text, model=None):
+
+    chunks = split_into_chunks(text)
+    if len(chunks) <= 1:
+        return synthesize_chunk(text, model)
+
+    # Synthesize sentences in parallel and join the mp3s frame by frame
+    audio = mp3.concat(_tts_executor.map(lambda chunk: synthesize_chunk(chunk, model), chunks))
     return audio
@@ -0,0 +1,245 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Connection pool metrics and optional adaptive pool sizing.
+
+Engines built with `InstrumentedQueuePool` record how long each checkout waited
+for a connection and which checkouts failed; pool events track the age of the
+connections handed out. Every `DB_POOL_METRICS_INTERVAL` seconds the metrics
+are logged and, with `DB_POOL_ADAPTIVE=1`, each pool is grown while checkouts
+wait longer than `DB_POOL_TARGET_WAIT_MS` at the 95th percentile, and shrunk
+back while they don't wait at all, within `DB_POOL_MIN_SIZE` and
+`DB_POOL_MAX_SIZE` connections.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Any
+
+import sqlalchemy
+from sqlalchemy.pool import QueuePool
+
+from middleware import logger
+
+METRICS_INTERVAL_SECONDS = float(os.environ.get("DB_POOL_METRICS_INTERVAL", "60"))
+ADAPTIVE = os.environ.get("DB_POOL_ADAPTIVE") == "1"
+MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "2"))
+MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "20"))
+TARGET_WAIT_MS = float(os.environ.get("DB_POOL_TARGET_WAIT_MS", "50"))
+
+# Checkout waits kept for the percentile calculations
+WAIT_WINDOW = 1000
+
+
+class PoolStats:
+    """Checkout statistics for one pool, reset each reporting interval."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.waits_ms: deque[float] = deque(maxlen=WAIT_WINDOW)
+            self.checkouts = 0
+            self.failed_checkouts = 0
+            self.max_connection_age = 0.0
+
+    def record_wait(self, wait_ms: float) -> None:
+        with self._lock:
+            self.waits_ms.append(wait_ms)
+            self.checkouts += 1
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failed_checkouts += 1
+
+    def record_age(self, age: float) -> None:
+        with self._lock:
+            self.max_connection_age = max(self.max_connection_age, age)
+
+    def wait_percentile(self, fraction: float) -> float:
+        with self._lock:
+            waits = sorted(self.waits_ms)
+        if not waits:
+            return 0.0
+        return waits[min(len(waits) - 1, int(fraction * len(waits)))]
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            waits = list(self.waits_ms)
+            snapshot = {
+                "checkouts": self.checkouts,
+                "failed_checkouts": self.failed_checkouts,
+                "max_connection_age_s": round(self.max_connection_age, 1),
+                "max_wait_ms": round(max(waits), 2) if waits else 0.0,
+            }
+        snapshot["p50_wait_ms"] = round(self.wait_percentile(0.5), 2)
+        snapshot["p95_wait_ms"] = round(self.wait_percentile(0.95), 2)
+        return snapshot
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that times how long each checkout waits for a connection.
+
+    Only time spent waiting for a connection to be returned to the pool counts.
+    Opening a new connection is slow too, but a larger pool would only open more
+    of them.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+        self._connecting = threading.local()
+
+    def _do_get(self) -> Any:
+        self._connecting.seconds = 0.0
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            self.stats.record_failure()
+            raise
+        waited = time.perf_counter() - start - self._connecting.seconds
+        self.stats.record_wait(max(waited, 0.0) * 1000)
+        return conn
+
+    def _create_connection(self) -> Any:
+        start = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            # Checkouts reset this first, other callers' time is never read
+            self._connecting.seconds = getattr(self._connecting, "seconds", 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def recreate(self) -> InstrumentedQueuePool:
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def resize(self, size: int, max_overflow: int) -> None:
+        # QueuePool has no public way to resize, but its limits are read on every
+        # checkout and checkin. `_overflow` counts the connections open beyond the
+        # pool size, so it moves by the change in size: the open connections are
+        # the same, only the size they're counted against changes. Surplus
+        # connections are closed as they are checked back in.
+        with self._overflow_lock:
+            self._overflow -= size - self._pool.maxsize
+            self._pool.maxsize = size
+            self._max_overflow = max_overflow
+
+
+_monitored: dict[str, sqlalchemy.engine.base.Engine] = {}
+_reporter: threading.Thread | None = None
+_reporter_lock = threading.Lock()
+
+
+def monitor(engine: sqlalchemy.engine.base.Engine, name: str) -> None:
+    """Tracks connection ages on `engine` and includes it in the periodic report."""
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        connection_record.info["created_at"] = time.monotonic()
+
+    @sqlalchemy.event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool = engine.pool
+        if isinstance(pool, InstrumentedQueuePool):
+            created_at = connection_record.info.get("created_at", time.monotonic())
+            pool.stats.record_age(time.monotonic() - created_at)
+
+    _monitored[name] = engine
+    _start_reporter()
+
+
+def pool_metrics() -> dict[str, dict[str, Any]]:
+    """Current metrics for every monitored pool."""
+    metrics = {}
+    for name, engine in list(_monitored.items()):
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        metrics[name] = {
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "in_use": pool.checkedout(),
+            "idle": pool.checkedin(),
+            # Negative while the pool is still filling up to its size
+            "overflow": max(pool.overflow(), 0),
+            **(pool.stats.snapshot() if isinstance(pool, InstrumentedQueuePool) else {}),
+        }
+    return metrics
+
+
+def adapt(pool: InstrumentedQueuePool) -> tuple[int, int] | None:
+    """Grows or shrinks `pool` based on recent checkout waits.
+
+    Returns:
+        The new (size, max_overflow), or None if the pool was left alone.
+    """
+    size = pool.size()
+    p95_wait = pool.stats.wait_percentile(0.95)
+    if p95_wait > TARGET_WAIT_MS and size < MAX_SIZE:
+        new_size = min(MAX_SIZE, max(size + 1, size * 3 // 2))
+    elif p95_wait < TARGET_WAIT_MS / 10 and pool.checkedout() < size // 2 and size > MIN_SIZE:
+        new_size = max(MIN_SIZE, size - 1)
+    else:
+        return None
+    # Keep the overflow headroom proportional, as with the default 5 + 2
+    new_overflow = max(1, new_size // 2)
+    pool.resize(new_size, new_overflow)
+    return new_size, new_overflow
+
+
+def report() -> None:
+    """Logs every pool's metrics, then adapts pool sizes if enabled."""
+    for name, metrics in pool_metrics().items():
+        logger.info("connection pool metrics", pool=name, **metrics)
+        pool = _monitored[name].pool
+        if not isinstance(pool, InstrumentedQueuePool):
+            continue
+        if ADAPTIVE:
+            resized = adapt(pool)
+            if resized:
+                logger.info(
+                    f"Resized {name} connection pool from {metrics['size']} "
+                    f"to {resized[0]} (+{resized[1]} overflow), "
+                    f"p95 checkout wait {metrics['p95_wait_ms']}ms"
+                )
+        pool.stats.reset()
+
+
+def _report_periodically() -> None:
+    while True:
+        time.sleep(METRICS_INTERVAL_SECONDS)
+        try:
+            report()
+        except Exception as e:
+            logger.warning(f"Unable to report connection pool metrics: {e}")
+
+
+def _start_reporter() -> None:
+    global _reporter
+    with _reporter_lock:
+        if _reporter is None:
+            _reporter = threading.Thread(
+                target=_report_periodically, name="pool-monitor", daemon=True
+            )
+            _reporter.start()
@@ -0,0 +1,95 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pathlib
+import sqlite3
+import time
+
+import pytest
+import sqlalchemy
+
+import pool_monitor
+from pool_monitor import InstrumentedQueuePool
+
+
+def make_engine(tmp_path: pathlib.Path) -> sqlalchemy.engine.Engine:
+    return sqlalchemy.create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=InstrumentedQueuePool,
+        pool_size=5,
+        max_overflow=2,
+        pool_timeout=0.1,
+    )
+
+
+def checkout_until_exhausted(engine: sqlalchemy.engine.Engine) -> int:
+    connections = []
+    try:
+        while len(connections) < 100:
+            connections.append(engine.connect())
+    except sqlalchemy.exc.TimeoutError:
+        pass
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def test_limit_before_resize(tmp_path: pathlib.Path) -> None:
+    assert checkout_until_exhausted(make_engine(tmp_path)) == 7
+
+
+@pytest.mark.parametrize("size, max_overflow", [(10, 5), (3, 1)])
+def test_resize_changes_connection_limit(
+    tmp_path: pathlib.Path, size: int, max_overflow: int
+) -> None:
+    engine = make_engine(tmp_path)
+    engine.pool.resize(size, max_overflow)
+    assert checkout_until_exhausted(engine) == size + max_overflow
+
+
+def test_resize_with_connections_open(tmp_path: pathlib.Path) -> None:
+    engine = make_engine(tmp_path)
+    open_connections = [engine.connect() for _ in range(6)]
+    assert engine.pool.overflow() == 1
+
+    engine.pool.resize(3, 1)
+    # Six are open against a size of three
+    assert engine.pool.overflow() == 3
+    for connection in open_connections:
+        connection.close()
+    # Those beyond the new size and overflow were closed on checkin
+    assert engine.pool.checkedin() == 3
+    assert checkout_until_exhausted(engine) == 4
+
+
+def test_slow_connects_are_not_checkout_waits(tmp_path: pathlib.Path) -> None:
+    def slow_connect() -> sqlite3.Connection:
+        # Like a Cloud SQL connector's TLS handshake and auth
+        time.sleep(pool_monitor.TARGET_WAIT_MS * 2 / 1000)
+        return sqlite3.connect(tmp_path / "pool.db", check_same_thread=False)
+
+    engine = sqlalchemy.create_engine(
+        "sqlite://", poolclass=InstrumentedQueuePool, creator=slow_connect,
+        pool_size=5, max_overflow=2,
+    )
+    connections = [engine.connect() for _ in range(6)]
+    for connection in connections:
+        connection.close()
+
+    pool = engine.pool
+    assert pool.stats.checkouts == 6
+    assert pool.stats.wait_percentile(0.95) < pool_monitor.TARGET_WAIT_MS
+    resized = pool_monitor.adapt(pool)
+    assert resized is None or resized[0] <= 5
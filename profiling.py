@@ -0,0 +1,179 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in sampling profiler for production requests.
+
+A request is profiled when it is the Nth since the last one (`PROFILE_SAMPLE_EVERY`,
+0 disables sampling) or when an admin sends the `X-Profile: 1` header. While any
+profiled request is running, a single background thread snapshots the stacks
+of the threads handling them every `PROFILE_INTERVAL_MS`.
+
+Samples are aggregated into collapsed stacks ("frame;frame;frame count"), the
+input format of flamegraph.pl and speedscope, and periodically written to
+`PROFILE_DIR/profile-<pid>.folded` so every worker's samples can be merged.
+"""
+
+from __future__ import annotations
+
+import glob
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+
+from flask import Flask, request
+
+from middleware import is_admin_request, logger
+
+PROFILE_HEADER = "X-Profile"
+
+# Deepest stack recorded per sample, frames beyond this are dropped from the root
+MAX_STACK_DEPTH = 128
+
+# Minimum seconds between rewrites of this process' profile file
+FLUSH_INTERVAL_SECONDS = 10
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame: FrameType | None) -> str:
+    """Renders a stack root-first as semicolon separated frame names."""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Periodically samples the stacks of registered threads."""
+
+    def __init__(self, interval: float, profile_dir: str) -> None:
+        self.interval = interval
+        self.profile_dir = profile_dir
+        self.samples: Counter[str] = Counter()
+        self._targets: dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._dirty = False
+        self._last_flush = 0.0
+
+    def start(self, thread_id: int, label: str) -> None:
+        """Starts sampling `thread_id`, with `label` as the root frame of its stacks."""
+        with self._lock:
+            self._targets[thread_id] = label
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="sampling-profiler", daemon=True
+                )
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, thread_id: int) -> None:
+        with self._lock:
+            self._targets.pop(thread_id, None)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                targets = dict(self._targets)
+            if not targets:
+                self.flush()
+                self._wakeup.clear()
+                self._wakeup.wait()
+                continue
+
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, label in targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self.samples[f"{label};{collapse_stack(frame)}"] += 1
+                self._dirty = True
+            del frames
+
+            if time.monotonic() - self._last_flush >= FLUSH_INTERVAL_SECONDS:
+                self.flush()
+            time.sleep(self.interval)
+
+    def flush(self) -> None:
+        """Writes this process' aggregated samples to its profile file."""
+        with self._lock:
+            if not self._dirty:
+                return
+            lines = [f"{stack} {count}\n" for stack, count in self.samples.items()]
+            self._dirty = False
+        self._last_flush = time.monotonic()
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"profile-{os.getpid()}.folded")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+
+
+def merged_profile(profile_dir: str) -> str:
+    """Merges the profile files of every worker into one collapsed stack listing."""
+    totals: Counter[str] = Counter()
+    for path in glob.glob(os.path.join(profile_dir, "profile-*.folded")):
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack and count.isdigit():
+                    totals[stack] += int(count)
+    return "".join(f"{stack} {count}\n" for stack, count in totals.most_common())
+
+
+sample_every = int(os.environ.get("PROFILE_SAMPLE_EVERY", "0"))
+profiler = SamplingProfiler(
+    interval=float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000,
+    profile_dir=os.environ.get("PROFILE_DIR", "/tmp/mrkia-profiles"),
+)
+_request_counter = itertools.count(1)
+
+
+def _should_profile() -> bool:
+    if sample_every and next(_request_counter) % sample_every == 0:
+        return True
+    # Only pay for token verification when the header asks for it
+    return request.headers.get(PROFILE_HEADER) == "1" and is_admin_request()
+
+
+def start_request_profile() -> None:
+    if not sample_every and PROFILE_HEADER not in request.headers:
+        return
+    if _should_profile():
+        request.profiled = True
+        profiler.start(threading.get_ident(), f"{request.method} {request.url_rule}")
+
+
+def stop_request_profile(exc: BaseException | None = None) -> None:
+    if getattr(request, "profiled", False):
+        profiler.stop(threading.get_ident())
+
+
+def init_app(app: Flask) -> None:
+    """Registers the request hooks that profile sampled requests."""
+    app.before_request(start_request_profile)
+    app.teardown_request(stop_request_profile)
+    if sample_every:
+        logger.info(f"Profiling 1 in every {sample_every} requests")
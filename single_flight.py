@@ -0,0 +1,154 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalesces concurrent identical calls into one.
+
+While a call decorated with `single_flight` is running, identical calls (same
+function and arguments) don't run it again: they wait for the running call and
+get its result, or its exception. Once it finishes, the next call runs afresh,
+so this complements the caches in `cache.py` rather than replacing them: put
+`cached` outside `single_flight` and concurrent cache misses share one upstream
+call.
+
+Calls in flight are tracked with `concurrent.futures.Future`s, which any thread
+can wait on and asyncio can await with `asyncio.wrap_future`. Coroutine
+functions can be decorated too, and waiters may be in other threads or event
+loops than the call they join. Coalescing is per process.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import inspect
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future
+from functools import wraps
+from typing import Any, TypeVar
+
+from cache import make_key
+
+a = TypeVar("a")
+
+
+class SingleFlight:
+    """The calls in flight for one group of functions, with coalescing counters."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._calls: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def join(self, key: str) -> tuple[Future, bool]:
+        """Returns the future for `key`, and whether the caller must run the call."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.executed += 1
+            return future, True
+
+    def finish(self, key: str, future: Future, result: Any = None,
+               error: BaseException | None = None) -> None:
+        # Later calls start a new flight rather than reuse a finished one
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def stats(self) -> dict[str, Any]:
+        calls = self.executed + self.coalesced
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+            "coalesced_ratio": round(self.coalesced / calls, 3) if calls else None,
+        }
+
+
+_groups: dict[str, SingleFlight] = {}
+_groups_lock = threading.Lock()
+
+
+def get_group(name: str) -> SingleFlight:
+    """Returns this process' single-flight group `name`, creating it on first use."""
+    with _groups_lock:
+        group = _groups.get(name)
+        if group is None:
+            group = _groups[name] = SingleFlight(name)
+    return group
+
+
+def all_stats() -> dict[str, dict[str, Any]]:
+    """Coalescing statistics for every group used so far."""
+    return {name: group.stats() for name, group in _groups.items()}
+
+
+def single_flight(name: str) -> Callable[[Callable[..., a]], Callable[..., a]]:
+    """Shares one run of the decorated function between concurrent identical calls.
+
+    Args:
+        name: the group the calls are counted under in `all_stats`
+    """
+
+    def decorator(func: Callable[..., a]) -> Callable[..., a]:
+        signature = inspect.signature(func)
+        group = get_group(name)
+
+        def call_key(args: tuple, kwargs: dict) -> str:
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            return make_key(func.__module__, func.__qualname__, arguments.arguments)
+
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def decorated_coroutine(*args: Any, **kwargs: Any) -> a:
+                key = call_key(args, kwargs)
+                future, leader = group.join(key)
+                if not leader:
+                    return await asyncio.wrap_future(future)
+                try:
+                    result = await func(*args, **kwargs)
+                except BaseException as e:
+                    group.finish(key, future, error=e)
+                    raise
+                group.finish(key, future, result)
+                return result
+
+            return decorated_coroutine
+
+        @wraps(func)
+        def decorated_function(*args: Any, **kwargs: Any) -> a:
+            key = call_key(args, kwargs)
+            future, leader = group.join(key)
+            if not leader:
+                return future.result()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                group.finish(key, future, error=e)
+                raise
+            group.finish(key, future, result)
+            return result
+
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,124 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+from single_flight import get_group, single_flight
+
+WAITERS = 8
+
+
+def wait_for_waiters(name: str, count: int) -> None:
+    deadline = time.monotonic() + 5
+    while get_group(name).coalesced < count:
+        assert time.monotonic() < deadline, "waiters never joined the call"
+        time.sleep(0.001)
+
+
+def run_concurrently(name: str, func: Callable[[], Any], release: threading.Event) -> list[Future]:
+    """Calls `func` from WAITERS threads, releasing the first call once all have joined."""
+    executor = ThreadPoolExecutor(WAITERS)
+    futures = [executor.submit(func) for _ in range(WAITERS)]
+    wait_for_waiters(name, WAITERS - 1)
+    release.set()
+    executor.shutdown()
+    return futures
+
+
+def test_waiters_share_one_result() -> None:
+    calls = []
+    release = threading.Event()
+
+    @single_flight("test-result")
+    def lookup(key: str) -> dict:
+        calls.append(key)
+        release.wait()
+        return {"key": key}
+
+    futures = run_concurrently("test-result", lambda: lookup("a"), release)
+    results = [future.result() for future in futures]
+
+    assert calls == ["a"]
+    assert all(result is results[0] for result in results)
+    assert get_group("test-result").stats()["in_flight"] == 0
+
+
+def test_waiters_share_one_exception() -> None:
+    calls = []
+    release = threading.Event()
+
+    @single_flight("test-exception")
+    def lookup(key: str) -> dict:
+        calls.append(key)
+        release.wait()
+        raise RuntimeError("upstream failed")
+
+    futures = run_concurrently("test-exception", lambda: lookup("a"), release)
+    errors = [future.exception() for future in futures]
+
+    assert calls == ["a"]
+    assert isinstance(errors[0], RuntimeError)
+    assert all(error is errors[0] for error in errors)
+
+
+def test_different_arguments_and_later_calls_run_again() -> None:
+    calls = []
+
+    @single_flight("test-separate")
+    def lookup(key: str, suffix: str = "") -> str:
+        calls.append(key + suffix)
+        return key + suffix
+
+    assert lookup("a") == "a"
+    # The same call with the default spelled out, once the first has finished
+    assert lookup("a", suffix="") == "a"
+    assert lookup("b") == "b"
+    assert calls == ["a", "a", "b"]
+
+
+def test_coroutine_waiters_share_one_result() -> None:
+    calls = []
+
+    @single_flight("test-coroutine")
+    async def lookup(key: str) -> dict:
+        calls.append(key)
+        await asyncio.sleep(0.05)
+        return {"key": key}
+
+    async def main() -> list[dict]:
+        return await asyncio.gather(*(lookup("a") for _ in range(WAITERS)))
+
+    results = asyncio.run(main())
+    assert calls == ["a"]
+    assert all(result is results[0] for result in results)
+
+
+def test_coroutine_waiters_share_one_exception() -> None:
+    @single_flight("test-coroutine-exception")
+    async def lookup(key: str) -> dict:
+        await asyncio.sleep(0.05)
+        raise RuntimeError("upstream failed")
+
+    async def main() -> list[BaseException]:
+        return await asyncio.gather(*(lookup("a") for _ in range(WAITERS)), return_exceptions=True)
+
+    errors = asyncio.run(main())
+    assert isinstance(errors[0], RuntimeError)
+    assert all(error is errors[0] for error in errors)
+    assert get_group("test-coroutine-exception").executed == 1
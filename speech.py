@@ -0,0 +1,97 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Answer audio that is synthesized after the answer text has been returned.
+
+`defer` stores the answer under an unguessable id and returns it; the audio is
+only generated when `synthesize` is called for that id, or ahead of time in the
+background when prefetching is requested. Pending answers live in the
+`deferred_speech` cache namespace and their audio, once generated, in the
+`answer_audio` namespace, so repeat fetches don't synthesize it again. Use the
+`shared` or `redis` cache backend when running more than one worker.
+"""
+
+from __future__ import annotations
+
+import secrets
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import get_cache
+from middleware import logger
+from parsing import text_to_speech
+
+PREFETCH_MAX_WORKERS = 4
+
+_prefetch_executor = ThreadPoolExecutor(
+    max_workers=PREFETCH_MAX_WORKERS, thread_name_prefix="speech-prefetch"
+)
+_prefetches: dict[str, Future] = {}
+_prefetches_lock = threading.Lock()
+
+
+def defer(answer: str, prefetch: bool = False, model: str | None = None) -> str:
+    """Registers `answer` for later synthesis.
+
+    Args:
+        answer: the answer text to speak
+        prefetch: start synthesizing in the background straight away
+        model: TTS model to synthesize with, None for the default
+
+    Returns:
+        The id to pass to `synthesize`.
+    """
+    audio_id = secrets.token_urlsafe(16)
+    get_cache("deferred_speech").set(audio_id, (answer, model))
+    if prefetch:
+        future = _prefetch_executor.submit(_generate, audio_id, answer, model)
+        with _prefetches_lock:
+            _prefetches[audio_id] = future
+        # Once finished the audio is in the answer audio cache, so stop tracking it
+        future.add_done_callback(lambda _: _forget_prefetch(audio_id))
+    return audio_id
+
+
+def _generate(audio_id: str, answer: str, model: str | None) -> bytes:
+    audio = text_to_speech(answer, model)
+    # The speech cache only keeps short answers, so keep this one by its id
+    get_cache("answer_audio").set(audio_id, audio)
+    return audio
+
+
+def _forget_prefetch(audio_id: str) -> None:
+    with _prefetches_lock:
+        _prefetches.pop(audio_id, None)
+
+
+def synthesize(audio_id: str) -> bytes | None:
+    """Returns the audio for a deferred answer, or None if the id is unknown or expired."""
+    audio = get_cache("answer_audio").get(audio_id)
+    if audio is not None:
+        return audio
+
+    with _prefetches_lock:
+        future = _prefetches.get(audio_id)
+    if future is not None:
+        try:
+            return future.result()
+        except Exception as e:
+            # Fall through and try again in the foreground
+            logger.warning(f"Prefetching audio {audio_id} failed: {e}")
+
+    deferred = get_cache("deferred_speech").get(audio_id)
+    if deferred is None:
+        return None
+    answer, model = deferred
+    return _generate(audio_id, answer, model)
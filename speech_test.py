@@ -0,0 +1,125 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+from flask.testing import FlaskClient
+import pytest
+
+import main
+import speech
+from cache import get_cache
+
+app = Flask(__name__)
+# Only the audio route, the main app's first request hooks need a database
+app.add_url_rule("/answers/<audio_id>/audio/", view_func=main.deferred_answer_audio)
+
+syntheses: list[str] = []
+release = threading.Event()
+
+
+def fake_text_to_speech(text: str, model: str | None = None) -> bytes:
+    syntheses.append(text)
+    assert release.wait(timeout=5)
+    if text.startswith("fail"):
+        raise RuntimeError("TTS unavailable")
+    return f"audio of {text}".encode()
+
+
+@pytest.fixture(autouse=True)
+def stand_in_tts(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(speech, "text_to_speech", fake_text_to_speech)
+    syntheses.clear()
+    release.set()
+
+
+@pytest.fixture
+def client() -> FlaskClient:
+    return app.test_client()
+
+
+def audio_url(audio_id: str) -> str:
+    return f"/answers/{audio_id}/audio/"
+
+
+def test_serves_prefetched_audio(client: FlaskClient) -> None:
+    audio_id = speech.defer("prefetched answer", prefetch=True)
+    deadline = time.monotonic() + 5
+    while get_cache("answer_audio").get(audio_id) is None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    for _ in range(2):
+        response = client.get(audio_url(audio_id))
+        assert response.status_code == 200
+        assert response.data == b"audio of prefetched answer"
+    assert syntheses == ["prefetched answer"]
+
+
+def test_waits_for_prefetch_in_progress(client: FlaskClient) -> None:
+    release.clear()
+    audio_id = speech.defer("slow answer", prefetch=True)
+    with ThreadPoolExecutor(1) as executor:
+        response = executor.submit(client.get, audio_url(audio_id))
+        time.sleep(0.1)
+        assert not response.done()
+        release.set()
+        assert response.result().data == b"audio of slow answer"
+    # The fetch joined the prefetch rather than synthesizing again
+    assert syntheses == ["slow answer"]
+
+
+def test_synthesizes_on_demand_without_prefetch(client: FlaskClient) -> None:
+    audio_id = speech.defer("on demand answer")
+    assert syntheses == []
+
+    assert client.get(audio_url(audio_id)).data == b"audio of on demand answer"
+    assert client.get(audio_url(audio_id)).data == b"audio of on demand answer"
+    assert syntheses == ["on demand answer"]
+
+
+def test_failed_prefetch_is_retried_on_demand(
+    client: FlaskClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    audio_id = speech.defer("fail once", prefetch=True)
+    deadline = time.monotonic() + 5
+    while len(syntheses) < 1 or audio_id in speech._prefetches:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    monkeypatch.setattr(speech, "text_to_speech", lambda text, model=None: b"recovered")
+
+    response = client.get(audio_url(audio_id))
+    assert response.status_code == 200
+    assert response.data == b"recovered"
+
+
+def test_unknown_id_is_not_found(client: FlaskClient) -> None:
+    assert client.get(audio_url("no-such-answer")).status_code == 404
+
+
+def test_expired_answer_is_not_found(client: FlaskClient) -> None:
+    audio_id = speech.defer("forgotten answer")
+    # What expiry leaves behind: the pending answer is gone from the cache
+    get_cache("deferred_speech").delete(audio_id)
+
+    assert client.get(audio_url(audio_id)).status_code == 404
+    assert syntheses == []
+
+
+def test_synthesis_failure_is_a_server_error(client: FlaskClient) -> None:
+    audio_id = speech.defer("fail always")
+    assert client.get(audio_url(audio_id)).status_code == 500
@@ -8,6 +8,20 @@ let cur_state = rec_state.AWAITING
 let isResponding = false
 let chatContext = []
 let mediaRecorder;
+let recording;
+
+// Whisper resamples everything to 16 kHz mono, so capture and encode no more than that
+const RECORDING_SAMPLE_RATE = 16000
+const RECORDING_BITS_PER_SECOND = 24000
+const RECORDING_MIME_TYPES = ['audio/webm;codecs=opus', 'audio/ogg;codecs=opus', 'audio/mp4', 'audio/webm']
+const RECORDING_EXTENSIONS = { 'audio/webm': 'webm', 'audio/ogg': 'ogg', 'audio/mp4': 'm4a' }
+// Audio is delivered in slices of this length, so slices of trailing silence can be dropped
+const RECORDING_TIMESLICE_MS = 250
+// RMS level (0 to 1) above which the microphone is hearing speech rather than silence
+const VOICE_LEVEL_THRESHOLD = 0.01
+const VOICE_POLL_INTERVAL_MS = 30
+// Silence kept after the last speech so the final word isn't clipped
+const TRAILING_SILENCE_MS = 500
 
 function sleep(ms) {
     return new Promise(resolve => setTimeout(resolve, ms));
@@ -46,21 +60,182 @@ function setButtonState(new_state) {
     cur_state = new_state
 }
 
-async function handleFinishRecording() {
+// Records how long the user waited between sending a question and hearing the answer
+function recordTimeToFirstAudio(requestStart, playbackMode) {
+    const elapsed = Math.round(performance.now() - requestStart)
+    console.log(`Time to first audio (${playbackMode}): ${elapsed}ms`)
+    if (navigator.sendBeacon) {
+        const payload = JSON.stringify({
+            time_to_first_audio_ms: elapsed,
+            playback_mode: playbackMode
+        })
+        navigator.sendBeacon('/client_metrics/', new Blob([payload], { type: 'application/json' }))
+    }
+}
+
+function createAnswerAudio(requestStart, playbackMode) {
+    const audioElement = new Audio();
+    audioElement.addEventListener("ended", () => { setButtonState(rec_state.AWAITING); }, false);
+    audioElement.addEventListener("playing", () => { recordTimeToFirstAudio(requestStart, playbackMode); }, { once: true });
+    return audioElement
+}
+
+function canStreamAudio(response) {
+    return response.body && window.MediaSource && MediaSource.isTypeSupported('audio/mpeg')
+}
+
+function appendToSourceBuffer(sourceBuffer, chunk) {
+    return new Promise((resolve, reject) => {
+        sourceBuffer.addEventListener('updateend', resolve, { once: true })
+        sourceBuffer.addEventListener('error', reject, { once: true })
+        sourceBuffer.appendBuffer(chunk)
+    })
+}
 
-    const blob = new Blob(chunks, { type: 'audio/mp3' });
-    const url = URL.createObjectURL(blob);
-    console.log(url);
+// Plays the answer as it downloads rather than waiting for the whole mp3
+function streamAudio(response, requestStart) {
+    const mediaSource = new MediaSource();
+    const audioElement = createAnswerAudio(requestStart, 'stream');
+    audioElement.src = URL.createObjectURL(mediaSource);
 
-    console.log(chunks)
+    return new Promise((resolve, reject) => {
+        mediaSource.addEventListener('sourceopen', async () => {
+            try {
+                const sourceBuffer = mediaSource.addSourceBuffer('audio/mpeg');
+                const reader = response.body.getReader();
+                let started = false
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) {
+                        break
+                    }
+                    await appendToSourceBuffer(sourceBuffer, value)
+                    if (!started) {
+                        started = true
+                        audioElement.play()
+                    }
+                }
+                if (mediaSource.readyState === 'open') {
+                    mediaSource.endOfStream();
+                }
+                resolve(audioElement)
+            } catch (err) {
+                reject(err)
+            }
+        }, { once: true })
+    })
+}
+
+function recordingMimeType() {
+    if (!MediaRecorder.isTypeSupported) {
+        return ''
+    }
+    return RECORDING_MIME_TYPES.find(type => MediaRecorder.isTypeSupported(type)) || ''
+}
+
+function createCaptureContext(stream) {
+    try {
+        const audioContext = new AudioContext({ sampleRate: RECORDING_SAMPLE_RATE })
+        return { audioContext, source: audioContext.createMediaStreamSource(stream) }
+    } catch (err) {
+        // Some browsers can't resample a microphone into a context at another rate
+        console.log(`Recording at the microphone's sample rate: ${err}`)
+        const audioContext = new AudioContext()
+        return { audioContext, source: audioContext.createMediaStreamSource(stream) }
+    }
+}
+
+// Routes the microphone through a mono 16 kHz graph, with an analyser to detect speech
+async function openMicrophone() {
+    const stream = await navigator.mediaDevices.getUserMedia({
+        audio: {
+            channelCount: 1,
+            sampleRate: RECORDING_SAMPLE_RATE,
+            echoCancellation: true,
+            noiseSuppression: true
+        }
+    });
+    const { audioContext, source } = createCaptureContext(stream)
+    const analyser = audioContext.createAnalyser()
+    analyser.fftSize = 1024
+    const destination = audioContext.createMediaStreamDestination()
+    destination.channelCount = 1
+    destination.channelCountMode = 'explicit'
+    source.connect(analyser)
+    source.connect(destination)
+    return {
+        stream,
+        audioContext,
+        analyser,
+        recordStream: destination.stream,
+        samples: new Float32Array(analyser.fftSize),
+        chunks: [],
+        lastVoiceAt: null,
+        resumedAt: null,
+        monitor: null
+    }
+}
+
+function closeMicrophone(recording) {
+    clearInterval(recording.monitor)
+    recording.stream.getTracks().forEach(track => track.stop())
+    recording.audioContext.close()
+}
+
+// Resumes the paused recorder once the user starts speaking, and notes when they last spoke
+function monitorVoice(recording, recorder) {
+    recording.analyser.getFloatTimeDomainData(recording.samples)
+    let sumOfSquares = 0
+    for (const sample of recording.samples) {
+        sumOfSquares += sample * sample
+    }
+    if (Math.sqrt(sumOfSquares / recording.samples.length) < VOICE_LEVEL_THRESHOLD) {
+        return
+    }
+    recording.lastVoiceAt = performance.now()
+    if (recorder.state === 'paused') {
+        recorder.resume()
+        recording.resumedAt = recording.lastVoiceAt
+    }
+}
+
+// Drops the slices recorded entirely after the speech ended. The first slice holds
+// the container header, so it's always kept.
+function trimTrailingSilence(recording) {
+    const cutoff = recording.lastVoiceAt + TRAILING_SILENCE_MS
+    return recording.chunks.filter(
+        (chunk, index) => index === 0 || chunk.receivedAt - RECORDING_TIMESLICE_MS <= cutoff
+    )
+}
+
+// WebM and Ogg recordings carry no duration the server can read cheaply, so send
+// how long the recorder ran, up to the end of the last slice kept
+function recordedDurationMs(recording, kept) {
+    return Math.max(0, Math.round(kept[kept.length - 1].receivedAt - recording.resumedAt))
+}
+
+async function handleFinishRecording() {
+    closeMicrophone(recording)
+    if (recording.lastVoiceAt === null || recording.chunks.length === 0) {
+        window.alert("I didn't hear a question. Please try again!")
+        setButtonState(rec_state.AWAITING);
+        return
+    }
+
+    const mimeType = (mediaRecorder.mimeType || recording.chunks[0].data.type).split(';')[0]
+    const kept = trimTrailingSilence(recording)
+    const blob = new Blob(kept.map(chunk => chunk.data), { type: mimeType });
+    console.log(`Recorded ${blob.size} bytes of ${mimeType}`)
 
     const formData = new FormData()
-    formData.append("audio_file", blob)
+    formData.append("audio_file", blob, `question.${RECORDING_EXTENSIONS[mimeType] || 'webm'}`)
     formData.append('chat_context', JSON.stringify(chatContext));
     formData.append('response_length', desiredResponseLength())
+    formData.append('duration_ms', recordedDurationMs(recording, kept))
 
     try {
         const token = await firebase.auth().currentUser.getIdToken();
+        const requestStart = performance.now();
         fetch('/ask/', {
             method: 'POST',
             headers: {
@@ -72,16 +247,22 @@ async function handleFinishRecording() {
                 chatContext.push(response.headers.get('transcription'))
                 chatContext.push(response.headers.get('answer'))
                 console.log(chatContext)
-                response.blob().then((blob) => {
-                    const objectURL = URL.createObjectURL(blob);
-                    const audioElement = new Audio();
-                    audioElement.addEventListener("ended", () => { setButtonState(rec_state.AWAITING); }, false);
-                    audioElement.src = objectURL;
-                    audioElement.play();
-                }).catch(error => {
-                    console.error("error from the blob:", error);
-                    setButtonState(rec_state.AWAITING);
-                })
+                if (canStreamAudio(response)) {
+                    streamAudio(response, requestStart).catch(error => {
+                        console.error("error streaming the audio:", error);
+                        setButtonState(rec_state.AWAITING);
+                    })
+                } else {
+                    response.blob().then((blob) => {
+                        const objectURL = URL.createObjectURL(blob);
+                        const audioElement = createAnswerAudio(requestStart, 'blob');
+                        audioElement.src = objectURL;
+                        audioElement.play();
+                    }).catch(error => {
+                        console.error("error from the blob:", error);
+                        setButtonState(rec_state.AWAITING);
+                    })
+                }
             }
             else {
                 console.error("Bad response", response)
@@ -106,12 +287,25 @@ async function startRecording() {
     if (firebase.auth().currentUser) {
         console.log("Starting recording")
         setButtonState(rec_state.RECORDING)
-        chunks = [];
-        const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
-        mediaRecorder = new MediaRecorder(stream);
-        mediaRecorder.ondataavailable = e => chunks.push(e.data);
+        recording = await openMicrophone();
+        const options = { audioBitsPerSecond: RECORDING_BITS_PER_SECOND }
+        const mimeType = recordingMimeType()
+        if (mimeType) {
+            options.mimeType = mimeType
+        }
+        mediaRecorder = new MediaRecorder(recording.recordStream, options);
+        const currentRecording = recording
+        mediaRecorder.ondataavailable = e => {
+            if (e.data.size > 0) {
+                currentRecording.chunks.push({ data: e.data, receivedAt: performance.now() })
+            }
+        };
         mediaRecorder.onstop = handleFinishRecording
-        mediaRecorder.start();
+        mediaRecorder.start(RECORDING_TIMESLICE_MS);
+        // Leading silence is never recorded: the recorder stays paused until speech starts
+        mediaRecorder.pause();
+        const recorder = mediaRecorder
+        recording.monitor = setInterval(() => monitorVoice(currentRecording, recorder), VOICE_POLL_INTERVAL_MS)
     } else {
         window.alert('User not signed in.');
     }
@@ -120,7 +314,8 @@ async function startRecording() {
 async function stopRecording() {
     setButtonState(rec_state.RESPONDING);
     console.log("stopping recording")
-    if (mediaRecorder && mediaRecorder.state === 'recording') {
+    if (mediaRecorder && mediaRecorder.state !== 'inactive') {
+        clearInterval(recording.monitor)
         mediaRecorder.stop();
     }
 }
@@ -0,0 +1,138 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in capture of anonymized request traces for load test replay.
+
+Set `TRACE_FILE` to append one compact JSON line per request. Traces hold only
+the shape of the traffic, never its content:
+
+    t   start time (unix seconds)     m   method
+    r   route rule, e.g. "/ask/"      s   status code
+    d   handling time (ms)            u   salted hash of the uid, if any
+    ab  uploaded audio bytes          ad  uploaded audio duration (ms)
+    c   chat context length           rl  requested response length
+
+The duration of mp3 uploads is measured from their frames. Browsers record
+WebM or Ogg, whose duration isn't cheap to read, so for those the duration the
+client reports in the `duration_ms` form field is used.
+
+Each line is written with a single append, so workers can share one file.
+`benchmarks/replay_traces.py` replays a trace file against the app.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import secrets
+import time
+
+from flask import Flask, Response, request
+
+import mp3
+from middleware import logger
+
+trace_file = os.environ.get("TRACE_FILE")
+# Without a fixed salt, uid hashes only line up within one process
+_salt = os.environ.get("TRACE_SALT") or secrets.token_hex(16)
+_fd: int | None = None
+
+
+def _anonymize(uid: str) -> str:
+    return hashlib.sha256(f"{_salt}:{uid}".encode("utf-8")).hexdigest()[:12]
+
+
+def _audio_fields(audio_file, reported_duration_ms: int | None) -> dict:
+    stream = audio_file.stream
+    stream.seek(0)
+    data = stream.read()
+    stream.seek(0)
+    fields = {"ab": len(data)}
+    if data[:3] == b"ID3" or (len(data) > 1 and data[0] == 0xFF and data[1] & 0xE0 == 0xE0):
+        try:
+            fields["ad"] = round(mp3.duration(data) * 1000)
+        except mp3.Mp3Error:
+            pass
+    if "ad" not in fields and reported_duration_ms is not None and reported_duration_ms >= 0:
+        fields["ad"] = reported_duration_ms
+    return fields
+
+
+def _int_or_none(value: str | None) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def build_trace(response: Response) -> dict:
+    record = {
+        "t": round(request.trace_start, 3),
+        "m": request.method,
+        "r": str(request.url_rule) if request.url_rule else None,
+        "s": response.status_code,
+        "d": round((time.time() - request.trace_start) * 1000, 1),
+    }
+    uid = getattr(request, "uid", None)
+    if uid:
+        record["u"] = _anonymize(uid)
+
+    if request.files:
+        audio_file = request.files.get("audio_file")
+        if audio_file is not None:
+            record.update(
+                _audio_fields(audio_file, _int_or_none(request.form.get("duration_ms")))
+            )
+    if "chat_context" in request.form:
+        try:
+            record["c"] = len(json.loads(request.form["chat_context"]))
+        except (TypeError, ValueError):
+            pass
+    if "response_length" in request.form:
+        record["rl"] = _int_or_none(request.form["response_length"])
+    return record
+
+
+def start_trace() -> None:
+    request.trace_start = time.time()
+
+
+def write_trace(response: Response) -> Response:
+    global _fd
+    try:
+        line = json.dumps(build_trace(response), separators=(",", ":")) + "\n"
+        if _fd is None:
+            _fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        os.write(_fd, line.encode("utf-8"))
+    except Exception as e:
+        # Tracing must never break the request being traced
+        logger.warning(f"Unable to write request trace: {e}")
+    return response
+
+
+def read_traces(path: str) -> list[dict]:
+    """Loads a trace file, ordered by start time."""
+    with open(path) as f:
+        traces = [json.loads(line) for line in f if line.strip()]
+    return sorted(traces, key=lambda trace: trace["t"])
+
+
+def init_app(app: Flask) -> None:
+    """Registers the request hooks that record traces, if `TRACE_FILE` is set."""
+    if not trace_file:
+        return
+    app.before_request(start_trace)
+    app.after_request(write_trace)
+    logger.info(f"Recording request traces to {trace_file}")